@@ -1,23 +1,159 @@
 """Helper functions for handling word documents
+
+The time here is spent in lxml (XML parsing and the XSLT) called from Python
+glue code, so performance work should reuse the compiled stylesheets and the
+parser and cache the converted formulas. Do not JIT it with numba (see
+jitutils): it does not speed up string and object code, it can slow it down.
 """
-import os
+import re
+from functools import lru_cache
 from pathlib import Path
-from latex2mathml.converter import convert as latex2mml
 from lxml import etree # pylint: disable=no-name-in-module # type: ignore
 
 _filespath = Path(__file__).parent
+_XSLT_PATH = str(_filespath / 'MML2OMML.XSL')
+# one hardened parser for the stylesheet and all formulas
+# (no ID index, DTD, entities or network needed for our own XML)
+_PARSER = etree.XMLParser(collect_ids=False, resolve_entities=False, no_network=True,
+                          load_dtd=False)
+# the stylesheets may only read (their imports), nothing else
+_XSLT_ACCESS = etree.XSLTAccessControl(read_network=False, write_network=False,
+                                       create_dir=False, write_file=False)
+_MML2OMML = etree.XSLT(etree.parse(_XSLT_PATH, _PARSER), # compiled once, it is reusable
+                       access_control=_XSLT_ACCESS)
+_OMML_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/math'
+_MML_NS = 'http://www.w3.org/1998/Math/MathML'
+# the same stylesheet applied to a wrapper of several <math> elements at once,
+# it gives one <m:oMath> for each of them
+_MML2OMML_BATCH = etree.XSLT(etree.fromstring(f'''<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+    xmlns:mml="{_MML_NS}" xmlns:m="{_OMML_NS}">
+  <xsl:import href="{Path(_XSLT_PATH).as_uri()}" />
+  <xsl:template match="/">
+    <batch>
+      <xsl:for-each select="*/*">
+        <m:oMath><xsl:apply-templates select="." /></m:oMath>
+      </xsl:for-each>
+    </batch>
+  </xsl:template>
+</xsl:stylesheet>'''.encode('utf8'), _PARSER), access_control=_XSLT_ACCESS)
+# formulas simple enough to build their OMML directly: a single token (a letter
+# or a number), optionally with a one character sub/superscript
+_TRIVIAL = re.compile(r'^(?:([A-Za-z]|[0-9]+)'
+                      r'|([A-Za-z]|[0-9]+)(?:_([A-Za-z0-9])|\^([A-Za-z0-9])))$')
 
-def get_math_oxml(latex):
-    """Converts a latex string to XML which can be inserted into Word .docx files"""
+def latex2mml(latex: str) -> str:
+    """Converts a latex string to MathML. latex2mathml is imported on the first
+    formula only, as importing it is slow and not every process needs it."""
+    from latex2mathml.converter import convert  # pylint: disable=import-outside-toplevel
+    return convert(latex)
+
+
+@lru_cache(maxsize=1024)
+def _oxml_bytes(latex: str) -> bytes:
+    """Converts a latex string to serialized OMML (cached, as the same formulas
+    recur throughout a document)"""
     mmlxml_str = latex2mml(latex)
-    tree = etree.fromstring(mmlxml_str)
-    xslt = etree.parse(os.path.join(_filespath, 'MML2OMML.XSL'))
-    transform = etree.XSLT(xslt)
-    mth = transform(tree).getroot()
+    tree = etree.fromstring(mmlxml_str, _PARSER)
+    return etree.tostring(_MML2OMML(tree).getroot())
+
+
+@lru_cache(maxsize=256)
+def _oxml_bytes_batch(latexes: tuple[str, ...]) -> tuple[bytes, ...]:
+    """Converts several latex strings to serialized OMML with one XSLT run"""
+    mmlxml_str = f'<batch xmlns="{_MML_NS}">' + \
+                 ''.join(latex2mml(latex) for latex in latexes) + '</batch>'
+    tree = etree.fromstring(mmlxml_str, _PARSER)
+    return tuple(etree.tostring(mth) for mth in _MML2OMML_BATCH(tree).getroot())
+
+
+def _trivial_oxml(match: re.Match):
+    """Builds the OMML of a trivial formula (see `_TRIVIAL`) the same way the
+    stylesheet would, but without the MathML conversion and the XSLT"""
+    def run(parent, text):
+        r = etree.SubElement(parent, f'{{{_OMML_NS}}}r')
+        etree.SubElement(r, f'{{{_OMML_NS}}}t').text = text
+    mth = etree.Element(f'{{{_OMML_NS}}}oMath', nsmap={'m': _OMML_NS, 'mml': _MML_NS})
+    text, base, sub, sup = match.groups()
+    if text is not None:
+        run(mth, text)
+        return mth
+    kind = 'Sub' if sub is not None else 'Sup'
+    script = etree.SubElement(mth, f'{{{_OMML_NS}}}s{kind}')
+    run(etree.SubElement(script, f'{{{_OMML_NS}}}e'), base)
+    run(etree.SubElement(script, f'{{{_OMML_NS}}}{kind.lower()}'), sub if sub is not None else sup)
     return mth
 
 
+def get_math_oxml(latex):
+    """Converts a latex string to XML which can be inserted into Word .docx files.
+    Every call returns a new element, so the caller can insert it anywhere."""
+    match = _TRIVIAL.match(latex)
+    if match is not None:
+        return _trivial_oxml(match)
+    return etree.fromstring(_oxml_bytes(latex), _PARSER)
+
+
+def get_math_oxml_batch(latexes: list[str]) -> list:
+    """Converts several latex strings (e.g. the formulas of a paragraph) to XML
+    elements like `get_math_oxml`, but with one XSLT run for all of them."""
+    results = [None]*len(latexes)
+    rest = [] # the indices of the non-trivial ones
+    for i, latex in enumerate(latexes):
+        match = _TRIVIAL.match(latex)
+        if match is not None:
+            results[i] = _trivial_oxml(match)
+        else:
+            rest.append(i)
+    if len(rest) == 1:
+        results[rest[0]] = get_math_oxml(latexes[rest[0]])
+    elif len(rest) > 1:
+        for i, oxml in zip(rest, _oxml_bytes_batch(tuple(latexes[i] for i in rest))):
+            results[i] = etree.fromstring(oxml, _PARSER)
+    return results
+
+
+def clear_math_cache():
+    """Empties the formula caches (for long-running processes)"""
+    _oxml_bytes.cache_clear()
+    _oxml_bytes_batch.cache_clear()
+
+
 def add_formula_par(doc, txt, **kwargs):
     """Helper to easily add latex as a paragraph to Word documents"""
     p = doc.add_paragraph(**kwargs)
     p._element.append(get_math_oxml(txt)) #pylint: disable=protected-access
+
+
+def add_mixed_par(doc, txt, **kwargs):
+    """Helper to add a paragraph of text with inline latex formulas between
+    `$` signs to Word documents (a literal dollar sign can be escaped as `\\$`).
+    The text is scanned once, then all the formulas are converted together."""
+    parts: list[tuple[bool, str]] = [] # (is formula, text)
+    i, n, start, in_math = 0, len(txt), 0, False
+    while i < n:
+        if txt[i] == '\\' and i+1 < n and txt[i+1] == '$':
+            i += 2 # escaped dollar, part of the current run
+            continue
+        if txt[i] == '$':
+            chunk = txt[start:i]
+            if in_math: # latex handles its own escapes
+                parts.append((True, chunk))
+            elif chunk:
+                parts.append((False, chunk.replace('\\$', '$')))
+            in_math = not in_math
+            start = i+1
+        i += 1
+    # the rest is text (with its opening dollar if the formula was not closed)
+    chunk = ('$' if in_math else '') + txt[start:].replace('\\$', '$')
+    if chunk:
+        parts.append((False, chunk))
+    # convert the formulas and add everything in order
+    formulas = iter(get_math_oxml_batch([text for is_math, text in parts if is_math]))
+    p = doc.add_paragraph(**kwargs)
+    for is_math, text in parts:
+        if is_math:
+            p._element.append(next(formulas)) #pylint: disable=protected-access
+        else:
+            p.add_run(text)
+    return p
@@ -3,19 +3,18 @@
 Calculates VFR routes where the legs are defined as a function
 """
 # general packages
-import json
 from pathlib import Path
 from typing import Optional, Union
 import textwrap
 import datetime
 import os
 import io
-import math
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # projection related packages
-from pyproj import Proj, Geod
 import numpy as np
 
 # pdf and imaging related packages
@@ -23,30 +22,33 @@ import PIL
 import matplotlib
 matplotlib.use("Agg")
 # pylint: disable=wrong-import-position
-import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 
-# document creation related packages
-from docx import Document
-from docx.shared import Cm
-
-# gpx read and create
-import gpxpy
+# document creation (docx) and gpx export packages are imported where they are
+# used, most workers never create documents and the imports are slow
 
 # package imports
 from .projutils import (
     PointLonLat, PointXY,
     ExtentLonLat, ExtentXY,
     _calculate_2d_transformation_matrix,
-    _apply_transformation_matrix,
+    _calculate_extent_transformation_matrix,
+    _apply_transformation_matrix_batch,
     _get_extent_from_points,
     _get_extent_from_extents,
+    _compose_transformation_matrices,
+    _TransformationCache,
+    _get_transformers,
+    _get_geod,
 )
-from .docxutils import add_formula_par
-from .rendering import SimpleRect
-from .maps import MapDefinition, MapManager
+from .docxutils import add_formula_par, add_mixed_par
+from .rendering import SimpleRect, TileRenderer, _acquire_map_figure, _release_map_figure
+from .rendering import _BackgroundCanvasAgg
+from .maps import MapDefinition
 from .geometry import VFRRouteState, VFRLeg, VFRTrack, VFRPoint, VFRCoordSystem, VFRAnnotation
-from .linear_approximation import rdp
-from .imageutils import paste_img
+from .geometry import _format_duration
+from .realtimedata import RealtimeDataCache
+from .serialization import route_to_dict, route_from_dict, dumps, loads
 # pylint: enable=wrong-import-position
 
 
@@ -63,6 +65,8 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
     HIGH_DPI = int(os.getenv("HIGH_DPI", "600"))
     LOW_DPI = int(os.getenv("LOW_DPI", "72"))
     DOC_DPI = int(os.getenv("DOC_DPI", "200"))
+    PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "1")) # zlib level (speed over size)
+    TRANS_CACHE_SIZE = 16 # number of map transformation matrices kept
 
 
     @property
@@ -92,10 +96,27 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         """A read-only property to access the requests.session assigned to this route"""
         return self._session
 
+    @property
+    def realtime_data(self):
+        """A read-only property to access the weather forecasts and magnetic
+        declinations downloaded for this route"""
+        return self._realtime_data
+
     @property
     def proj(self):
-        """A read-only property to access the projection object"""
-        return self._proj
+        """A read-only property to access the projection function. It has
+        the same signature as `pyproj.Proj` i.e. `proj(x, y, inverse=False)`"""
+        return self._project
+
+    @property
+    def proj_fwd(self):
+        """A read-only property to access the lon-lat -> x-y projection function"""
+        return self._proj_fwd
+
+    @property
+    def proj_inv(self):
+        """A read-only property to access the x-y -> lon-lat projection function"""
+        return self._proj_inv
 
     @property
     def geod(self):
@@ -122,6 +143,18 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         """A read-only property to access the inverse transformation matrix"""
         return self._matrix_cropmap2map
 
+    @property
+    def matrix_fullmap2cropmap(self):
+        """A read-only property to access the composed (FULL_WORLD_XY to
+        MAPCROP_XY) transformation matrix"""
+        return self._composed_matrices[(VFRCoordSystem.FULL_WORLD_XY, VFRCoordSystem.MAPCROP_XY)]
+
+    @property
+    def matrix_cropmap2fullmap(self):
+        """A read-only property to access the composed (MAPCROP_XY to
+        FULL_WORLD_XY) inverse transformation matrix"""
+        return self._composed_matrices[(VFRCoordSystem.MAPCROP_XY, VFRCoordSystem.FULL_WORLD_XY)]
+
     def __init__(self,  # pylint: disable=too-many-arguments,disable=too-many-positional-arguments
                  name: str,
                  mapdef: MapDefinition,
@@ -144,7 +177,21 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         self.tracksfolder = tracksfolder
         self.legs: list[VFRLeg] = []
         self.tracks: list[VFRTrack] = []
-        self._session = session if session else requests.Session()
+        if session is None:
+            # our own session: pool the connections and retry transient errors
+            # (a session passed in is configured by its owner)
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                                  max_retries=Retry(total=3, backoff_factor=0.2)))
+        self._session = session
+        self._realtime_data = RealtimeDataCache(self._session)
+        self._basemap: Optional[tuple[tuple, np.ndarray]] = None # (key, composited tiles)
+        self._version = 0 # incremented on every change of the content
+        self._serialized: Optional[tuple[tuple, str]] = None # (key, JSON string)
+        self._extent_key: Optional[tuple] = None # the inputs of the last calc_extents
+        self._trans_cache = _TransformationCache(self.TRANS_CACHE_SIZE)
+        self._composed_key: Optional[tuple] = None # the inputs of _composed_matrices
+        self._composed_matrices: dict[tuple[VFRCoordSystem, VFRCoordSystem], np.ndarray] = {}
         self.waypoints: list[tuple[str, VFRPoint]] = []
         self.is_closed = True
         self.area_of_interest = {
@@ -158,10 +205,27 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
                 VFRCoordSystem.LONLAT, self)
         }
         self._use_realtime_data = False
+        self._proj_str = "+proj=lcc +lon_0=-90 +lat_1=46 +lat_2=48 +ellps=WGS84"
+        self._proj_fwd, self._proj_inv = _get_transformers(self._proj_str)
+        self._geod = _get_geod(self._proj_str)
         self.calc_extents()
         self.calc_transformations()
 
 
+    def _project(self, x, y, inverse: bool = False):
+        """Project lon-lat coordinates to FULL_WORLD_XY or back (if `inverse`).
+        Accepts scalars and numpy arrays as well."""
+        if inverse:
+            return self._proj_inv(x, y)
+        return self._proj_fwd(x, y)
+
+
+    def _changed(self):
+        """Private helper to note that the content of the route changed
+        (it invalidates the cached JSON string)."""
+        self._version += 1
+
+
     def ensure_state(self,
                       required_state: VFRRouteState,
                       ensure_minimum: bool = True,
@@ -182,19 +246,19 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
                 We have to have exactly the given state (no more, no less).
         """
         if ensure_exactly:
-            if self._state.value!=required_state.value:
+            if self._state!=required_state:
                 raise RuntimeError(
                     "VFRFunctionRoutes object not in required state: " + \
                     f"Current {self._state}, required exact state: {required_state}."
                 )
         elif ensure_minimum:
-            if self._state.value<required_state.value:
+            if self._state<required_state:
                 raise RuntimeError(
                     "VFRFunctionRoutes object not in required state: " + \
                     f"Current {self._state}, required minimum state: {required_state}."
                 )
         else:
-            if self._state.value>required_state.value:
+            if self._state>required_state:
                 raise RuntimeError(
                     "VFRFunctionRoutes object not in required state: " + \
                     f"Current {self._state}, required maximum state: {required_state}."
@@ -211,29 +275,29 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         """
         if self._state==required_state:
             return
-        if self._state.value<required_state.value: # forward stepping
-            if self._state == VFRRouteState.INITIATED and required_state.value > self._state.value:
+        if self._state<required_state: # forward stepping
+            if self._state == VFRRouteState.INITIATED and required_state > self._state:
                 # INITIADED -> AREAOFINTEREST
                 self._state = VFRRouteState.AREAOFINTEREST
                 self.calc_extents()
                 self.calc_transformations()
-            if self._state==VFRRouteState.AREAOFINTEREST and required_state.value>self._state.value:
+            if self._state==VFRRouteState.AREAOFINTEREST and required_state>self._state:
                 # AREAOFINTEREST -> WAYPOINTS
                 self._state = VFRRouteState.WAYPOINTS
                 self.waypoints_to_legs()
                 self.calc_extents()
                 self.calc_transformations()
-            if self._state == VFRRouteState.WAYPOINTS and required_state.value > self._state.value:
+            if self._state == VFRRouteState.WAYPOINTS and required_state > self._state:
                 # WAYPOINTS -> LEGS
                 self._state = VFRRouteState.LEGS
                 self.legs_to_annotations()
                 self.calc_extents()
                 self.calc_transformations()
-            if self._state == VFRRouteState.LEGS and required_state.value > self._state.value:
+            if self._state == VFRRouteState.LEGS and required_state > self._state:
                 # LEGS -> ANNOTATIONS
                 self._state = VFRRouteState.ANNOTATIONS
             if self._state == VFRRouteState.ANNOTATIONS and \
-                    required_state.value > self._state.value:
+                    required_state > self._state:
                 # ANNOTATIONS -> FINALIZED
                 self.finalize()
         else: # backward stepping
@@ -244,25 +308,30 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         """
         Converts waypoints to legs considering the already existing ones
         """
-        for i, wp_start in enumerate(self.waypoints if self.is_closed else self.waypoints[:-1]):
-            wp_end = self.waypoints[i+1 if i+1<len(self.waypoints) else 0]
-                # circle around (last point is the same as first)
+        num_legs = len(self.waypoints) if self.is_closed else max(len(self.waypoints)-1, 0)
+        if num_legs > 0 and len(self.legs) > 0:
+            # the annotations of the existing legs are adjusted below, it needs
+            # the LEGS state (the transition is done once, before the legs change)
+            self.set_state(VFRRouteState.LEGS)
+        self._changed()
+        # precompute the (start, end) pairs of the legs
+        names = [name for name, _ in self.waypoints]
+        starts = np.array([(p.lon, p.lat) for _, p in self.waypoints], dtype=float).reshape(-1, 2)
+        ends = np.roll(starts, -1, axis=0) # circle around (last point is the same as first)
+        for i, ((start_lon, start_lat), (end_lon, end_lat)) in \
+                enumerate(zip(starts[:num_legs].tolist(), ends[:num_legs].tolist())):
+            start_name, end_name = names[i], names[(i+1) % len(names)]
             if len(self.legs)>i: # we have a leg at that position
                 leg = self.legs[i]
                 # so we adjust its endpoints position (not the x value)
-                leg.points[0] = (VFRPoint(wp_start[1].lon,
-                                          wp_start[1].lat,
-                                          VFRCoordSystem.LONLAT, self),
-                                 leg.points[0][1])
-                leg.points[-1] = (VFRPoint(wp_end[1].lon,
-                                           wp_end[1].lat,
-                                           VFRCoordSystem.LONLAT, self),
-                                  leg.points[-1][1])
+                leg.points = [(VFRPoint(start_lon, start_lat, VFRCoordSystem.LONLAT, self),
+                               leg.points[0][1])] + \
+                             leg.points[1:-1] + \
+                             [(VFRPoint(end_lon, end_lat, VFRCoordSystem.LONLAT, self),
+                               leg.points[-1][1])]
                 # we adjust the name of the leg
-                leg.name = f"{wp_start[0]} -- {wp_end[0]}"
+                leg.name = f"{start_name} -- {end_name}"
                 # we adjust the annotations so we have the first and last match
-                self.set_state(VFRRouteState.LEGS)
-                    # needed for the annotations but at this point we already are in that state
                 if len(leg.annotations)>0:
                     leg.annotations[0].x = leg.points[0][1]
                 else:
@@ -273,17 +342,13 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
                     leg.add_annotation('???', leg.points[-1][1], (0,0))
             else: # we don't have a leg yet
                 # so we add a new one
-                func_range = f"x=0\\textrm{{ at {wp_start[0]}, }}x=1\\textrm{{ at {wp_end[0]}}}"
-                self.add_leg(f"{wp_start[0]} -- {wp_end[0]}", f"x^{i+1}",
+                func_range = f"x=0\\textrm{{ at {start_name}, }}x=1\\textrm{{ at {end_name}}}"
+                self.add_leg(f"{start_name} -- {end_name}", f"x^{i+1}",
                              func_range,
                              [
-                                 (VFRPoint(wp_start[1].lon,
-                                           wp_start[1].lat,
-                                           VFRCoordSystem.LONLAT, self),
+                                 (VFRPoint(start_lon, start_lat, VFRCoordSystem.LONLAT, self),
                                   0),
-                                 (VFRPoint(wp_end[1].lon,
-                                           wp_end[1].lat,
-                                           VFRCoordSystem.LONLAT, self),
+                                 (VFRPoint(end_lon, end_lat, VFRCoordSystem.LONLAT, self),
                                   1)
                              ])
 
@@ -292,6 +357,7 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         """
         Transfers information from leg points to annotations (at least a start and an end is needed)
         """
+        self._changed()
         for leg in self.legs:
             if len(leg.annotations) > 0:
                 leg.annotations[0].x = leg.points[0][1]
@@ -311,6 +377,19 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         self._state = VFRRouteState.FINALIZED
 
 
+    def _prefetch_weather_and_magdev(self):
+        """Downloads the weather forecasts and magnetic declinations of all
+        annotations in parallel (if realtime data is used), so drawing the
+        annotations later finds them in the route's cache.
+        """
+        if not (VFRAnnotation.ALWAYS_USE_REAL_WEATHER or self.use_realtime_data):
+            return
+        self._realtime_data.prefetch(((p.lon, p.lat) for p in (a.lonlat_point
+                                                                for l in self.legs
+                                                                for a in l.annotations)),
+                                     self.dof)
+
+
     def set_area_of_interest(self,
                              top_left_x: float,
                              top_left_y: float,
@@ -320,16 +399,17 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         """Change the area of interest rectangle based on
         full map x-y coordinates.
         """
+        self._changed()
         self.ensure_state(VFRRouteState.INITIATED)
+        (tl_lon, br_lon), (tl_lat, br_lat) = (
+            c.tolist() for c in VFRPoint.project_points_batch([top_left_x, bottom_right_x],
+                                                              [top_left_y, bottom_right_y],
+                                                              VFRCoordSystem.MAP_XY,
+                                                              VFRCoordSystem.LONLAT,
+                                                              self))
         self.area_of_interest = {
-            'top-left': VFRPoint(top_left_x,
-                                 top_left_y,
-                                 VFRCoordSystem.MAP_XY, self)
-                                 .project_point(VFRCoordSystem.LONLAT),
-            'bottom-right': VFRPoint(bottom_right_x,
-                                     bottom_right_y,
-                                     VFRCoordSystem.MAP_XY, self)
-                                     .project_point(VFRCoordSystem.LONLAT)
+            'top-left': VFRPoint(tl_lon, tl_lat, VFRCoordSystem.LONLAT, self),
+            'bottom-right': VFRPoint(br_lon, br_lat, VFRCoordSystem.LONLAT, self)
         }
 
     def set_area_of_interest_lonlat(self,
@@ -341,6 +421,7 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         """Change the area of interest rectangle based on
         world longitude-latitude coordinates.
         """
+        self._changed()
         self.ensure_state(VFRRouteState.INITIATED)
         self.area_of_interest = {
             'top-left': VFRPoint(top_left_lon, top_left_lat, VFRCoordSystem.LONLAT, self),
@@ -361,23 +442,68 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         if size:
             figsize = fig.get_size_inches()
             dpi = min(size[0] / figsize[0], size[1] / figsize[1])
-        fig.savefig(buf, format="png", dpi=dpi, transparent=True)
+        fig.savefig(buf, format="png", dpi=dpi, transparent=True,
+                    pil_kwargs={"compress_level": self.PNG_COMPRESS_LEVEL})
         buf.seek(0)
         return buf
 
 
+    def _calc_legs_track_points(self,
+                                with_annotations: bool = True
+                               ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Private helper to prepare the drawing of all legs (see
+        `VFRLeg.calc_track_points`). Only the MatPlotLib artists are created
+        afterwards."""
+        return [l.calc_track_points(with_annotations) for l in self.legs]
+
+
+    def _route_lines(self,
+                     with_annotations: bool = True,
+                     with_tracks: bool = True
+                    ) -> tuple[list[np.ndarray], list[str], list[float]]:
+        """Private helper to collect the lines of the legs (and optionally of
+        the tracks) as (N, 2) MAPCROP_XY arrays with their colors and widths.
+        `with_annotations` also prepares the annotations of the legs."""
+        lines = [np.column_stack(track)
+                 for track in self._calc_legs_track_points(with_annotations)]
+        colors = [l.color for l in self.legs]
+        widths = [l.lw for l in self.legs]
+        if with_tracks:
+            lines.extend(np.column_stack(t.calc_track_points()) for t in self.tracks)
+            colors.extend(t.color for t in self.tracks)
+            widths.extend(2 for _ in self.tracks)
+        return lines, colors, widths
+
+
+    def _draw_route(self, ax, with_annotations: bool = True, with_tracks: bool = True) -> int:
+        """Private helper to draw the legs (optionally with their annotation
+        bubbles) and the tracks of the route on a MatPlotLib Axes.
+        All lines go into one LineCollection (a single artist) instead of
+        separate artists for each leg and track.
+        Returns the time spent on the annotation calculations."""
+        lines, colors, widths = self._route_lines(with_annotations, with_tracks)
+        if len(lines) > 0:
+            # same look and stacking as the lines of `ax.plot`
+            ax.add_collection(LineCollection(lines, colors=colors, linewidths=widths,
+                                             capstyle='projecting', joinstyle='round',
+                                             zorder=2))
+        calc_time = 0
+        if with_annotations:
+            for l in self.legs:
+                calc_time += l.draw_annotations(ax)
+        return calc_time
+
+
     def draw_annotations(self):
         """Draw the route with annotations into a MatPlotLib Figure.
         Used for SVG conversion to later serve to the frontend for local drawing.
+        The Figure comes from a pool, give it back with `_release_map_figure`
+        when done (SVGRenderer does that).
         """
-        fig = plt.figure()
-        ax = plt.Axes(fig, [0., 0., 1., 1.])
-        ax.set_axis_off()
-        fig.add_axes(ax)
+        self._prefetch_weather_and_magdev()
+        fig, ax = _acquire_map_figure()
 
-        calc_time = 0
-        for l in self.legs:
-            calc_time += l.draw(ax, True)
+        calc_time = self._draw_route(ax, with_annotations=True, with_tracks=False)
 
         print(f'calculation time: {calc_time:15,d}')
 
@@ -387,45 +513,63 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
     def draw_tracks(self):
         """Draw the Route without annotations into a MatPlotLib Figure.
         Used for SVG conversion to later serve to the frontend for local drawing.
+        The Figure comes from a pool, give it back with `_release_map_figure`
+        when done (SVGRenderer does that).
         """
-        fig = plt.figure()
-        ax = plt.Axes(fig, [0., 0., 1., 1.])
-        ax.set_axis_off()
-        fig.add_axes(ax)
+        fig, ax = _acquire_map_figure()
 
-        for l in self.legs:
-            l.draw(ax, False)
-        for t in self.tracks:
-            t.draw(ax)
+        self._draw_route(ax, with_annotations=False, with_tracks=True)
 
         return fig
 
 
+    def get_track_lines(self) -> tuple[list[np.ndarray], list[str], list[float]]:
+        """Get the lines `draw_tracks` would draw (the legs and the tracks) as
+        (N, 2) MAPCROP_XY arrays with their colors and widths.
+        Used by SVGRenderer to write the SVG paths directly (no MatPlotLib).
+        """
+        return self._route_lines(with_annotations=False, with_tracks=True)
+
+
     def add_waypoint(self, name: str, point: VFRPoint):
         """Add a new waypoint to the Route"""
+        self._changed()
         point.route = self
         self.waypoints.append((name, point.project_point(VFRCoordSystem.LONLAT)))
 
 
+    def _points_from_dicts(self, pts: list[dict]) -> list[VFRPoint]:
+        """Private helper to convert the points received from the frontend
+        (either MAPCROP_XY x-y or lon-lat) to lon-lat VFRPoints. The x-y
+        ones are projected together in one batch."""
+        xy_idx = [i for i, pt in enumerate(pts) if 'x' in pt and 'y' in pt]
+        lons, lats = VFRPoint.project_points_batch([pts[i]["x"] for i in xy_idx],
+                                                   [pts[i]["y"] for i in xy_idx],
+                                                   VFRCoordSystem.MAPCROP_XY,
+                                                   VFRCoordSystem.LONLAT,
+                                                   self)
+        projected = dict(zip(xy_idx, zip(lons.tolist(), lats.tolist())))
+        return [VFRPoint(*projected[i], VFRCoordSystem.LONLAT, self)
+                if i in projected else
+                VFRPoint(pt["lon"], pt["lat"], VFRCoordSystem.LONLAT, self)
+                for i, pt in enumerate(pts)]
+
+
     def update_waypoints(self, wps: list[dict], is_closed: bool):
         """Update the waypoints based on the data received from the frontend."""
+        self._changed()
         # calculate new waypoints
-        self.waypoints = [(
-            wp["name"],
-                VFRPoint(wp["x"],
-                         wp["y"],
-                         VFRCoordSystem.MAPCROP_XY, self)
-                         .project_point(VFRCoordSystem.LONLAT)
-            if 'x' in wp and 'y' in wp else
-                VFRPoint(wp["lon"],
-                         wp["lat"],
-                         VFRCoordSystem.LONLAT, self)
-        ) for wp in wps]
+        self.waypoints = list(zip((wp["name"] for wp in wps), self._points_from_dicts(wps)))
         self.is_closed = is_closed
 
 
     def update_legs(self, legs: list[dict]):
         """Update the legs based on the data received from the frontend."""
+        self._changed()
+        # project the constraint points of all legs in one batch
+        # (MAPCROP_XY -> LONLAT does not depend on the leg, the leg is set on them below)
+        projected = iter(self._points_from_dicts([pt for leg in legs
+                                                  for pt in leg["points"][1:-1]]))
         # set legs according to edits
         for i, leg in enumerate(legs):
             curleg = self.legs[i]
@@ -436,28 +580,14 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
             latex = leg["function_name"]
             curleg.function_name = latex
             curleg.calc_function()
-            # setup constraint points
+            # setup constraint points (the endpoints are the waypoints, kept as they are)
             lp_start, lp_end = curleg.points[0], curleg.points[-1]
-            newpoints: list[tuple[VFRPoint, float]] = []
-            for j, pt in enumerate(leg["points"]):
-                if j==0:
-                    newpoints.append((lp_start[0], pt["func_x"]))
-                elif j==len(leg["points"])-1:
-                    newpoints.append((lp_end[0], pt["func_x"]))
-                else:
-                    if 'x' in pt and 'y' in pt:
-                        p = VFRPoint(pt["x"],
-                                     pt["y"],
-                                     VFRCoordSystem.MAPCROP_XY, self, curleg) \
-                                     .project_point(VFRCoordSystem.LONLAT)
-                    else:
-                        p = VFRPoint(pt["lon"],
-                                     pt["lat"],
-                                     VFRCoordSystem.LONLAT, self, curleg)
-                    newpoints.append((
-                        p,
-                        pt["func_x"]
-                    ))
+            pts = leg["points"]
+            newpoints: list[tuple[VFRPoint, float]] = \
+                [(lp_start[0], pts[0]["func_x"])] if len(pts) > 0 else []
+            newpoints.extend((next(projected), pt["func_x"]) for pt in pts[1:-1])
+            if len(pts) > 1:
+                newpoints.append((lp_end[0], pts[-1]["func_x"]))
             curleg.points = newpoints
             # recalculate
             curleg.calc_transformations()
@@ -465,18 +595,17 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
 
     def update_annotations(self, legs: list[dict]):
         """Update the annotations based on the data received from the frontend."""
-        for i, l in enumerate(legs):
-            if i>len(self.legs)-1:
-                break
-            if self.legs[i].name!=l['name']:
+        self._changed()
+        for i, (leg, l) in enumerate(zip(self.legs, legs)): # extra legs are ignored
+            if leg.name!=l['name']:
                 print(f"WARNING: leg number {i} name does not match "+
-                      f"({self.legs[i].name}!={l['name']})")
-            self.legs[i].annotations = [VFRAnnotation(self.legs[i],
-                                                      a['name'],
-                                                      a['func_x'],
-                                                      (a['ofs']['x'], a['ofs']['y']))
-                                        for a in l['annotations']
-                                       ]
+                      f"({leg.name}!={l['name']})")
+            leg.annotations = [VFRAnnotation(leg,
+                                             a['name'],
+                                             a['func_x'],
+                                             (a['ofs']['x'], a['ofs']['y']))
+                               for a in l['annotations']
+                              ]
 
 
     def add_leg(self,
@@ -485,6 +614,7 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
                 function_range: str,
                 points: list[tuple[VFRPoint, float]]) -> VFRLeg:
         """Initialize and add a leg to the current route"""
+        self._changed()
         self.ensure_state(VFRRouteState.WAYPOINTS)
         for p, _ in points:
             p.route = self
@@ -504,6 +634,7 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
                 if xmlstring is not given)
             color: str
         """
+        self._changed()
         self.ensure_state(VFRRouteState.ANNOTATIONS)
         # ensure no name clash
         (ofname, ofext), i = os.path.splitext(fname), 0
@@ -517,12 +648,11 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
 
     def update_tracks(self, tracks):
         """Update the tracks based on the data received from the frontend."""
-        newtracks: list[VFRTrack] = []
+        self._changed()
+        colors = {nt['name']: nt['color'] for nt in reversed(tracks)} # first one wins
+        self.tracks = [t for t in self.tracks if t.fname in colors]
         for t in self.tracks:
-            if t.fname in [nt['name'] for nt in tracks]:
-                newtracks.append(t)
-                t.color = [nt['color'] for nt in tracks if nt['name']==t.fname][0]
-        self.tracks = newtracks
+            t.color = colors[t.fname]
 
 
     def calc_transformations(self):
@@ -546,51 +676,75 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         # to consider:
         #   map false_easting, false_northing values calc/hardcoded
         #   map scale
-        # calculate transformations for LONLAT<->FULL_WORLD_XY
-        self._proj_str = "+proj=lcc +lon_0=-90 +lat_1=46 +lat_2=48 +ellps=WGS84"
-        self._proj = Proj(self._proj_str)
-        self._geod = Geod(self._proj_str)
-        #print(self._proj(16,48.5))
-        #print(self._proj(17,47.5))
+        # transformations for LONLAT<->FULL_WORLD_XY are built once (see __init__)
+        #print(self._proj_fwd(16,48.5))
+        #print(self._proj_fwd(17,47.5))
         # calculate transformations for FULL_WORLD_XY<->MAP_XY
-        p = [PointXY(x, y) for x, y in [self._proj(ll.lon, ll.lat)
-             for ll in self.map.points.keys()]] # convert to fullworld map coord
-        pp = [PointXY(pxy.x/72*self.LOW_DPI, pxy.y/72*self.LOW_DPI)
-              for pxy in self.map.points.values()]
-                # must scale it to LOW_DPI from default pdf metric of 72
-        self._matrix_fullmap2map = _calculate_2d_transformation_matrix(p, pp)
-            # calc matrix from fullworld map coord to map coord
-        self._matrix_map2fullmap = np.linalg.inv(self._matrix_fullmap2map)
+        key_fullmap = ('fullmap2map', self._proj_str, tuple(self.map.points.items()),
+                       self.LOW_DPI)
+        if key_fullmap not in self._trans_cache:
+            lonlat = np.array(list(self.map.points.keys()), dtype=float).reshape(-1, 2)
+            p = np.column_stack(self._proj_fwd(lonlat[:, 0], lonlat[:, 1]))
+                # convert to fullworld map coord
+            pp = np.array(list(self.map.points.values()), dtype=float).reshape(-1, 2) \
+                 / 72*self.LOW_DPI
+                    # must scale it to LOW_DPI from default pdf metric of 72
+            matrix = _calculate_2d_transformation_matrix(p, pp)
+                # calc matrix from fullworld map coord to map coord
+            self._trans_cache.put(key_fullmap, matrix)
+        self._matrix_fullmap2map, self._matrix_map2fullmap = self._trans_cache[key_fullmap]
         #print("TEST lonlat to mapxy:")
         #for i, (lonlat, xy) in enumerate(self.PDF_IN_WORLD_XY.items()):
         #    print(f"  {lonlat} -> {p[i]} -> {xy} vs "+
         #          f"{_apply_transformation_matrix(p[i], self._matrix_fullmap2map)}")
         # calculate transformations for MAP_XY<->MAPCROP_XY
-        p = self.get_mapxyextent()
-        pp = [
-            (0, 0),
-            (0, (p.maxy-p.miny)*self.HIGH_DPI/self.LOW_DPI),
-            ((p.maxx-p.minx)*self.HIGH_DPI/self.LOW_DPI, 0),
-            ((p.maxx-p.minx)*self.HIGH_DPI/self.LOW_DPI,
-             (p.maxy-p.miny)*self.HIGH_DPI/self.LOW_DPI),
-        ]  # also scale it up!
-        p = [
-            PointXY(p.minx, p.miny),
-            PointXY(p.minx, p.maxy),
-            PointXY(p.maxx, p.miny),
-            PointXY(p.maxx, p.maxy),
-        ]
-        self._matrix_map2cropmap = _calculate_2d_transformation_matrix(p, pp)
-        self._matrix_cropmap2map = np.linalg.inv(self._matrix_map2cropmap)
+        key_cropmap = ('map2cropmap', key_fullmap, tuple(self.extent),
+                       self.HIGH_DPI, self.LOW_DPI)
+        if key_cropmap not in self._trans_cache:
+            p = self.get_mapxyextent()
+            self._trans_cache.put(key_cropmap, _calculate_extent_transformation_matrix(
+                p,
+                (p.maxx-p.minx)*self.HIGH_DPI/self.LOW_DPI,
+                (p.maxy-p.miny)*self.HIGH_DPI/self.LOW_DPI)) # also scale it up!
+        self._matrix_map2cropmap, self._matrix_cropmap2map = self._trans_cache[key_cropmap]
         #print("TEST mapxy to cropmapxy:")
         #for i, (mapxy, cropmapxy) in enumerate(zip(p, pp)):
         #    print(f"  {mapxy} -> {cropmapxy} vs "+
         #          f"{_apply_transformation_matrix(mapxy, self._matrix_map2cropmap)}")
+        # pre-compose the matrices of the multi-step transformations
+        # (the legs are recalculated anyway, only the map matrices can be unchanged)
+        if self._composed_key != key_cropmap:
+            self._compose_map_matrices()
+            self._composed_key = key_cropmap
         # calculate transformations for each leg
         for leg in self.legs:
             leg.calc_transformations()
 
 
+    def _compose_map_matrices(self):
+        """Private helper to pre-compose the matrices of the multi-step map transformations"""
+        crop, mapxy, full = VFRCoordSystem.MAPCROP_XY, VFRCoordSystem.MAP_XY, \
+                            VFRCoordSystem.FULL_WORLD_XY
+        self._composed_matrices = {
+            (full, mapxy): self._matrix_fullmap2map,
+            (mapxy, crop): self._matrix_map2cropmap,
+            (full, crop): _compose_transformation_matrices(self._matrix_fullmap2map,
+                                                           self._matrix_map2cropmap),
+            (crop, mapxy): self._matrix_cropmap2map,
+            (mapxy, full): self._matrix_map2fullmap,
+            (crop, full): _compose_transformation_matrices(self._matrix_cropmap2map,
+                                                           self._matrix_map2fullmap),
+        }
+
+
+    def composed_matrix(self,
+                        from_system: VFRCoordSystem,
+                        to_system: VFRCoordSystem) -> np.ndarray:
+        """Get the (pre-composed) transformation matrix between two of the map
+        coordinate systems (MAPCROP_XY, MAP_XY and FULL_WORLD_XY)."""
+        return self._composed_matrices[(from_system, to_system)]
+
+
     def calc_extents(self, margin_x: float = .2, margin_y: Optional[float] = None):
         """Calculates and saves the extents of the neccessary map.
         
@@ -614,21 +768,22 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
                                     self.area_of_interest["bottom-right"].lat,
                                     self.area_of_interest["top-left"].lon,
                                     self.area_of_interest["bottom-right"].lon)
+        # nothing changed since the last calculation: the extent is still valid
+        key = (self._version, self._state, lat0, lat1, lon0, lon1, margin_x, margin_y)
+        if key == self._extent_key:
+            return
+        self._extent_key = key
         area_of_interest = ExtentLonLat(
             min(lon0, lon1),
             min(lat0, lat1),
             max(lon0, lon1),
             max(lat0, lat1)
         )
-        if self._state in [VFRRouteState.INITIATED,
-                           VFRRouteState.AREAOFINTEREST,
-                           VFRRouteState.WAYPOINTS]:
+        if self._state <= VFRRouteState.WAYPOINTS:
             # at this stage we only have area of interest
             # (which is always set, at least to a default)
             self.extent = area_of_interest
-        elif self._state in [VFRRouteState.LEGS,
-                             VFRRouteState.ANNOTATIONS,
-                             VFRRouteState.FINALIZED]:
+        else: # LEGS, ANNOTATIONS or FINALIZED
             # get the automatic bounding box
             if len(self.legs)==0 and len(self.tracks)==0:
                 # no legs, no tracks fall back to waypoints extent
@@ -647,11 +802,13 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
             # add margins
             if margin_y is None:
                 margin_y = margin_x
+            dlon = (extent.maxlon-extent.minlon)*margin_x
+            dlat = (extent.maxlat-extent.minlat)*margin_y
             extent_with_margins = ExtentLonLat(
-                    extent.minlon - (extent.maxlon-extent.minlon)*margin_x,
-                    extent.minlat - (extent.maxlat-extent.minlat)*margin_y,
-                    extent.maxlon + (extent.maxlon-extent.minlon)*margin_x,
-                    extent.maxlat + (extent.maxlat-extent.minlat)*margin_y
+                    extent.minlon - dlon,
+                    extent.minlat - dlat,
+                    extent.maxlon + dlon,
+                    extent.maxlat + dlat
                 )
             # get the bounding box of the automatic and the manually defined
             # (i.e. only increase manually given box)
@@ -668,31 +825,29 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         """Get the extent of the Route.
         It is calculated based on the points of the functions.
         """
-        p = [
-            PointLonLat(self.extent.minlon, self.extent.minlat), # minlon-minlat -> leftbottom
-            PointLonLat(self.extent.minlon, self.extent.maxlat), # minlon-maxlat -> lefttop
-            PointLonLat(self.extent.maxlon, self.extent.minlat), # maxlon-minlat -> rightbottom
-            PointLonLat(self.extent.maxlon, self.extent.maxlat), # maxlon-maxlat -> righttop
-        ]
-        p = [self._proj(ll.lon, ll.lat) for ll in p] # projected to FULL_WORLD_XY
-        p = [_apply_transformation_matrix(pp, self._matrix_fullmap2map)
-             for pp in p] # projected to MAP_XY (LOW_DPI)
-        p = [PointXY(pp[0], pp[1]) for pp in p]
-        return ExtentXY(
-            min(pp.x for pp in p),
-            min(pp.y for pp in p),
-            max(pp.x for pp in p),
-            max(pp.y for pp in p)
-        )
+        lons = np.array([self.extent.minlon, # minlon-minlat -> leftbottom
+                         self.extent.minlon, # minlon-maxlat -> lefttop
+                         self.extent.maxlon, # maxlon-minlat -> rightbottom
+                         self.extent.maxlon]) # maxlon-maxlat -> righttop
+        lats = np.array([self.extent.minlat,
+                         self.extent.maxlat,
+                         self.extent.minlat,
+                         self.extent.maxlat])
+        xs, ys = self._proj_fwd(lons, lats) # projected to FULL_WORLD_XY
+        xs, ys = _apply_transformation_matrix_batch(
+            xs, ys, self._matrix_fullmap2map) # projected to MAP_XY (LOW_DPI)
+        return ExtentXY(float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max()))
 
 
     def draw_map(self, use_realtime: Optional[bool] = None):  # pylint: disable=too-many-locals
         """Draws a matplotlib based map of the defined route.
         
         Args:
+            use_realtime:
+                Optionally override the realtime data usage while drawing.
         
         Returns:
-            The matplotlib axes of the final plot.
+            The PNG image of the map.
         """
         self.ensure_state(VFRRouteState.FINALIZED)
 
@@ -701,42 +856,25 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         if use_realtime is not None:
             if use_realtime!=self.use_realtime_data:
                 old_rtd, self.use_realtime_data, set_rtd = self.use_realtime_data, True, True
-
-        # save the original clear function (to be restored in finally)
-        from matplotlib.backends import backend_agg # pylint: disable=import-outside-toplevel
-        orig_clear = backend_agg.RendererAgg.clear
+        self._prefetch_weather_and_magdev()
 
         image_size = PointXY(800, 600)
 
+        fig = None
         try:
-            # setup clear function to draw background
+            # the composited tiles are the background of the drawing
+            basemap = None
             tiles = self.map.get_tilerenderer(int(os.getenv('DOC_DPI', '200')))
             if tiles is not None:
-                tile_list, crop, image_size, tile_range = \
-                    tiles.get_tile_list_for_area(self.calc_basemap_clip())
-                def custom_background(renderer):
-                    arr = np.asarray(renderer.buffer_rgba())
-                    for p in tile_list:
-                        tile = np.asarray(tiles.get_tile(p.x, p.y)[1])
-                        # we need to shift the images, cropping not needed (its outside anyway)
-                        x = int((p.x - tile_range[0])*tiles.tile_size[0] - crop.p0.x)
-                        y = int((p.y - tile_range[2])*tiles.tile_size[1] - crop.p0.y)
-                        paste_img(arr, tile, x, y)
-                backend_agg.RendererAgg.clear = custom_background # type: ignore
+                basemap = self._get_basemap(tiles)
+                image_size = PointXY(basemap.shape[1], basemap.shape[0])
 
             # initialize map
-            from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas  # pylint: disable=import-outside-toplevel
-            fig = plt.figure()
-            canvas = FigureCanvas(fig)
-            ax = plt.Axes(fig, [0., 0., 1., 1.])
-            ax.set_axis_off()
-            fig.add_axes(ax)
+            fig, ax = _acquire_map_figure()
+            canvas = _BackgroundCanvasAgg(fig, basemap)
 
             # draw the map parts
-            for l in self.legs:
-                l.draw(ax)
-            for t in self.tracks:
-                t.draw(ax)
+            self._draw_route(ax, with_annotations=True, with_tracks=True)
 
             # render the overlay
             fig.patch.set_alpha(0.0)      # transparent background instead of white # type: ignore
@@ -746,26 +884,39 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
             ax.set_xlim(0, image_size.x/self.DOC_DPI*self.HIGH_DPI)
             ax.set_ylim(image_size.y/self.DOC_DPI*self.HIGH_DPI, 0)
             canvas.draw()
-            img_buf = canvas.buffer_rgba()
+
+            # return the composited (the image shares the figure's buffer, so
+            # the figure can only be released after it is encoded)
             img = PIL.Image.frombuffer("RGBA", # type: ignore
                                        (int(image_size.x), int(image_size.y)),
-                                       img_buf,
+                                       canvas.buffer_rgba(),
                                        "raw",
                                        "RGBA", 0, 1)
-            plt.close(fig)
+            buf = io.BytesIO()
+            img.save(buf, 'png', compress_level=self.PNG_COMPRESS_LEVEL)
+            return buf.getvalue()
 
         finally:
+            if fig is not None:
+                _release_map_figure(fig)
             # restore realtime wind state
             if set_rtd:
                 self.use_realtime_data = old_rtd
-            # restore matplotlib default
-            backend_agg.RendererAgg.clear = orig_clear
 
-        # return the composited
-        buf = io.BytesIO()
-        img.save(buf, 'png')
-        buf.seek(0)
-        return buf.getvalue()
+
+    def _get_basemap(self, tiles: TileRenderer) -> np.ndarray:
+        """Composites the map tiles of the route's area into one RGBA image.
+        The last one is cached (keyed by the map, the resolution and the area),
+        so the documents and images of the same route don't read and decode
+        the tiles again."""
+        clip = self.calc_basemap_clip()
+        key = (tiles.tileset_name, tiles.dpi,
+               tuple(round(c, 3) for c in (clip.p0.x, clip.p0.y, clip.p1.x, clip.p1.y)))
+        if self._basemap is not None and self._basemap[0] == key:
+            return self._basemap[1]
+        basemap = tiles.composite_area(clip)
+        self._basemap = (key, basemap)
+        return basemap
 
 
     def calc_basemap_clip(self) -> SimpleRect:
@@ -776,17 +927,11 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         lat0, lat1, lon0, lon1 = self.extent.minlat, self.extent.maxlat, \
                                  self.extent.minlon, self.extent.maxlon
         # adjust for non-rectangle because of projection type
-        corners_lonlat = [
-            VFRPoint(lon0, lat0, route=self),
-            VFRPoint(lon1, lat1, route=self),
-            VFRPoint(lon1, lat0, route=self),
-            VFRPoint(lon0, lat1, route=self)
-        ]
-        corners_map = [p.project_point(to_system=VFRCoordSystem.MAP_XY) for p in corners_lonlat]
-        x0 = min(p.x for p in corners_map)
-        y0 = min(p.y for p in corners_map)
-        x1 = max(p.x for p in corners_map)
-        y1 = max(p.y for p in corners_map)
+        xs, ys = VFRPoint.project_points_batch([lon0, lon1, lon1, lon0],
+                                               [lat0, lat1, lat0, lat1],
+                                               VFRCoordSystem.LONLAT, VFRCoordSystem.MAP_XY,
+                                               self)
+        x0, y0, x1, y1 = float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max())
         # the order of them is important
         if y1<y0:
             y0, y1 = y1, y0
@@ -813,16 +958,19 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
             - 3rd element is the length of the curve segment in meters
             - 4th element is the time used for that curve segment
         """
+        from docx import Document  # pylint: disable=import-outside-toplevel
+        from docx.shared import Cm  # pylint: disable=import-outside-toplevel
         self.ensure_state(VFRRouteState.FINALIZED)
         # draw map if we don't have it yet and save the image
         old_rtd, set_rtd = False, False
         if not self.use_realtime_data:
             old_rtd, self.use_realtime_data, set_rtd = self.use_realtime_data, True, True
         image = self.draw_map()
-        imgname = os.path.join(self.outfolder if self.outfolder is not None
-                               else '', self.name+'.png')
-        with open(imgname, "wb") as f:
-            f.write(image)
+        if save:
+            imgname = os.path.join(self.outfolder if self.outfolder is not None
+                                   else '', self.name+'.png')
+            with open(imgname, "wb") as f:
+                f.write(image)
 
         # header and image
         doc = Document()
@@ -836,17 +984,21 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         doc.add_heading('Route Plan', 0)
         doc.add_paragraph(f"Planned speed: {self.speed} KIAS.")
         doc.add_paragraph(f"Wind forecast for {self.dof:%Y-%m-%d %H:%M %Z}.")
-        doc.add_picture(f'{imgname}', width=Cm(19.00))
+        with io.BytesIO(image) as imgbuf:
+            doc.add_picture(imgbuf, width=Cm(19.00))
         doc.add_page_break()
 
         # legs
-        totdist, tottime, tottimewc = 0, 0, 0
         for leg in self.legs:
             # leg heading and definiton
             doc.add_heading(leg.name, level=1)
             doc.add_heading("Definition", level=2)
             add_formula_par(doc, leg.function_name, style="List Bullet")
-            add_formula_par(doc, leg.function_range, style="List Bullet")
+            # the range is a formula or a text with inline $...$ formulas
+            if '$' in leg.function_range:
+                add_mixed_par(doc, leg.function_range, style="List Bullet")
+            else:
+                add_formula_par(doc, leg.function_range, style="List Bullet")
             doc.add_heading("Segments", level=2)
 
             # leg table header
@@ -866,18 +1018,15 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
 
             # leg table rows (per annotations)
             for ann in leg.annotations:
-                curdist, curtime, curtimewc = self.add_annotation_to_doc(tab, ann)
-                totdist += curdist
-                tottime += curtime
-                tottimewc += curtimewc
+                self.add_annotation_to_doc(tab, ann)
 
-        # total distance/time
+        # total distance/time (of the cached annotation summaries)
+        summaries = [ann.summary(self.dof) for leg in self.legs for ann in leg.annotations]
+        totdist = sum(s.seglen or 0 for s in summaries)
+        tottime = sum(s.segtime or 0 for s in summaries)
+        tottimewc = sum(s.segtime_wind or 0 for s in summaries)
         doc.add_paragraph(f"Total: {totdist/1852:.0f} NM, " +
-                          f"{math.floor(tottime):2d}: \
-                            {math.floor((tottime-math.floor(tottime))*60):02d} / " +
-                          f"{math.floor(tottimewc):2d}: \
-                            {math.floor((tottimewc-math.floor(tottimewc))*60):02d}"
-                         )
+                          f"{_format_duration(tottime)} / {_format_duration(tottimewc)}")
 
 
         # save it
@@ -900,19 +1049,14 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         Args
             tab: the table in the word document
             ann: the annotation to add
-
-        Returns:
-            tuple: distance, time, wind corrected time of the current
-                   annotation segment of the route
         """
-        seglen = ann.seglen
-        segtime = ann.segtime
-        segtime_wind = sum(ann.times_withwind)
-        seghdgs = ann.headings
-        seghdg = seghdgs[-1]
-        wind_corrs = ann.wind_corrections(headings=seghdgs)
-        wind_corr = wind_corrs[-1] if wind_corrs else None
-        magdev = ann.magnetic_deviation(self.dof)
+        summary = ann.summary(self.dof)
+        seglen = summary.seglen
+        segtime = summary.segtime
+        segtime_wind = summary.segtime_wind
+        seghdg = summary.heading
+        wind_corr = summary.wind_correction
+        magdev = summary.magnetic_deviation
 
 
         row_cells = tab.add_row().cells
@@ -926,22 +1070,15 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         row_cells[4].text = \
                     f"{seglen/1852 if seglen is not None else '-' \
                        :{'' if seglen is None else '.1f'}}NM"
-        row_cells[5].text = f"{math.floor(segtime) if segtime is not None \
-                                       else '-':{'' if segtime is None else '2d'}}" + \
-                                    f":{math.floor((segtime-math.floor(segtime))*60) \
-                                        if segtime is not None else '--' \
-                                        :{'' if segtime is None else '02d'}}"
-        row_cells[6].text = f"{math.floor(segtime_wind) if segtime_wind is not None \
-                                       else '-':{'' if segtime_wind is None else '2d'}}"+\
-                                    f":{math.floor((segtime_wind-math.floor(segtime_wind))*60) \
-                                        if segtime_wind is not None else '--' \
-                                        :{'' if segtime_wind is None else '02d'}}"
-        row_cells[7].text = f"{ann.wind_dir:3d}\N{DEGREE SIGN} {ann.wind_speed:.0f}kts"
-
-        curdist = seglen if seglen is not None else 0
-        curtime = segtime if segtime is not None else 0
-        curtimewc = segtime_wind if segtime_wind is not None else 0
-        return curdist, curtime, curtimewc
+        row_cells[5].text = _format_duration(segtime)
+        row_cells[6].text = _format_duration(segtime_wind)
+        row_cells[7].text = f"{summary.wind_dir:3d}\N{DEGREE SIGN} {summary.wind_speed:.0f}kts"
+
+
+    def _calc_legs_plan_points(self) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Private helper to approximate all legs for the flight plan (see
+        `VFRLeg.calc_plan_points`). The GPX points are created afterwards."""
+        return [l.calc_plan_points() for l in self.legs]
 
 
     def save_plan(self):
@@ -950,26 +1087,17 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         The functions are approximated by straight lines
         (otherwise SkyDemon really slows down).
         """
+        import gpxpy.gpx  # pylint: disable=import-outside-toplevel
         self.ensure_state(VFRRouteState.FINALIZED)
         gpx = gpxpy.gpx.GPX()  # type: ignore
         gpx.name = "Elmebeteg VFR útvonal"
         gpx.time = datetime.datetime.now()
         rte = gpxpy.gpx.GPXRoute(name="Elmebeteg VFR útvonal")  # type: ignore
-        for leg in self.legs:
-            x = np.linspace(min(x for p, x in leg.points),
-                            max(x for p, x in leg.points),
-                            500
-                            )
-            breakpoints = rdp(np.column_stack((x, np.array([leg.function(xx) for xx in x]))), 0.025)
-            psrc = [VFRPoint(x,
-                             y,
-                             VFRCoordSystem.FUNCTION, self, leg)
-                    for x, y in breakpoints]
-            ps = [p.project_point(VFRCoordSystem.LONLAT) for p in psrc]
-            pt = [gpxpy.gpx.GPXRoutePoint(p.lat,  # type: ignore
-                                          p.lon,
+        for leg, (lons, lats) in zip(self.legs, self._calc_legs_plan_points()):
+            pt = [gpxpy.gpx.GPXRoutePoint(lat,  # type: ignore
+                                          lon,
                                           name=leg.name if i==0 else None)
-                  for i, p in enumerate(ps)]
+                  for i, (lon, lat) in enumerate(zip(lons.tolist(), lats.tolist()))]
             rte.points.extend(pt)
         gpx.routes.append(rte)
         return gpx.to_xml()
@@ -983,45 +1111,21 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
         return s
 
 
+    def _serialization_key(self) -> tuple:
+        """Private helper: the cached JSON string is valid as long as this does
+        not change (the simple attributes are set directly from outside)."""
+        return (self._version, self.name, self.map.name, self.speed, self.dof, self._state)
+
     def to_dict(self):
         """Converts the object to serializable dictionary."""
-        # initiate json object with basic info
-        jsonrte = {
-            'name': self.name,
-            'mapname': self.map.name,
-            'speed': self.speed,
-            'dof': self.dof.isoformat(),
-            'state': self._state.name
-        }
-        # step 1: area of interest
-        #if self._state.value>=VFRRouteState.AREAOFINTEREST.value:
-        jsonrte['step1'] = { 'area_of_interest': {
-            'top-left': self.area_of_interest['top-left'].to_dict(),
-            'bottom-right': self.area_of_interest['bottom-right'].to_dict(),
-        }}
-        # step 2: waypoints
-        #if self._state.value>=VFRRouteState.WAYPOINTS.value:
-        jsonrte['step2'] = { 'waypoints': [(wp[0], wp[1].to_dict()) for wp in self.waypoints],
-                             'is_closed': self.is_closed }
-        # step 3: legs
-        #if self._state.value>=VFRRouteState.LEGS.value:
-        jsonrte['step3'] = { 'legs': [leg.to_dict() for leg in self.legs] }
-        # step 4: annotation points
-        #if self._state.value>=VFRRouteState.ANNOTATIONS.value:
-        jsonrte['step4'] = {
-            'annotations': [[ann.to_dict()
-                             for ann in leg.annotations]
-                            for leg in self.legs]
-            }
-        # step 5: tracks
-        #if self._state.value>=VFRRouteState.FINALIZED.value:
-        jsonrte['step5'] = { 'tracks': [t.to_dict() for t in self.tracks]}
-        # return
-        return jsonrte
+        return route_to_dict(self)
 
     def to_json(self):
-        """Serializes the object to JSON string."""
-        return json.dumps(self.to_dict(), indent=2)
+        """Serializes the object to JSON string (cached until the route changes)."""
+        key = self._serialization_key()
+        if self._serialized is None or self._serialized[0] != key:
+            self._serialized = (key, dumps(self.to_dict()))
+        return self._serialized[1]
 
 
     @classmethod
@@ -1031,10 +1135,7 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
                  outfolder: Union[str, Path, None] = None,
                  tracksfolder: Union[str, Path, None] = None):
         """Deserializes the object from a JSON string."""
-        # decode json
-        jsonrte = json.loads(jsonstring)
-        # load it
-        return VFRFunctionRoute.from_dict(jsonrte, session, workfolder, outfolder, tracksfolder)
+        return cls.from_dict(loads(jsonstring), session, workfolder, outfolder, tracksfolder)
 
     @classmethod
     def from_dict(cls, jsonrte: dict,
@@ -1043,49 +1144,4 @@ class VFRFunctionRoute:  # pylint: disable=too-many-instance-attributes,disable=
                  outfolder: Union[str, Path, None] = None,
                  tracksfolder: Union[str, Path, None] = None):
         """Deserializes the object from a dictionary."""
-        if MapManager.instance() is None:
-            raise ValueError('There is no MapManager initialized')
-        # initiate with basic info
-        rte = VFRFunctionRoute(jsonrte['name'],
-                               MapManager.instance().maps.get(jsonrte['mapname']), # type: ignore
-                               jsonrte['speed'],
-                               datetime.datetime.fromisoformat(jsonrte['dof']),
-                               session, workfolder, outfolder, tracksfolder)
-        state = VFRRouteState[jsonrte['state']]
-        # step 1: area of interest
-        #if state.value>=VFRRouteState.AREAOFINTEREST.value:
-        rte.area_of_interest = {
-            'top-left': VFRPoint.from_dict(
-                jsonrte['step1']['area_of_interest']['top-left'],
-                rte),
-            'bottom-right': VFRPoint.from_dict(
-                jsonrte['step1']['area_of_interest']['bottom-right'],
-                rte),
-        }
-        #rte.set_state(VFRRouteState.AREAOFINTEREST)
-        # step 2: waypoints
-        #if state.value>=VFRRouteState.WAYPOINTS.value:
-        rte.waypoints = [(name, VFRPoint.from_dict(p, rte))
-                         for name, p in jsonrte['step2']['waypoints']]
-        rte.is_closed = jsonrte['step2'].get('is_closed', True)
-        #rte.set_state(VFRRouteState.WAYPOINTS)
-        # step 3: legs
-        #if state.value>=VFRRouteState.LEGS.value:
-        rte.legs = [VFRLeg.from_dict(leg, rte)
-                    for leg in jsonrte['step3']['legs']]
-        #rte.set_state(VFRRouteState.LEGS)
-        # step 4: annotation points
-        #if state.value>=VFRRouteState.ANNOTATIONS.value:
-        for i, l in enumerate(jsonrte['step4']['annotations']):
-            leg = rte.legs[i]
-            leg.annotations = [VFRAnnotation.from_dict(ann, leg)
-                               for ann in l]
-        #rte.set_state(VFRRouteState.ANNOTATIONS)
-        # step 5: tracks
-        #if state.value>=VFRRouteState.FINALIZED.value:
-        rte.tracks = [VFRTrack.from_dict(t, rte)
-                      for t in jsonrte['step5']['tracks']]
-        #rte.set_state(VFRRouteState.FINALIZED)
-        # set final state and return
-        rte.set_state(state)
-        return rte
+        return route_from_dict(cls, jsonrte, session, workfolder, outfolder, tracksfolder)
@@ -4,15 +4,18 @@ Geometry classes for a VFR route defined by functions
 """
 # general packages
 from pathlib import Path
-import traceback
-from typing import Optional, Union, TYPE_CHECKING
+import logging
+from typing import NamedTuple, Optional, Union, TYPE_CHECKING
+from collections.abc import Sequence
+import array
+import io
 import textwrap
-from enum import Enum, auto
+from enum import Enum, IntEnum, auto
 import datetime
 import time
 import os
-import math
 import json
+from functools import lru_cache
 from typing_extensions import Self
 
 # projection related packages
@@ -33,20 +36,26 @@ import sympy.abc
 
 # package imports
 from .projutils import (
-    PointLonLat,
     ExtentLonLat,
     PointXY,
     _calculate_2d_transformation_matrix,
-    _apply_transformation_matrix,
+    _apply_transformation_matrix_batch,
+    _apply_transformation_matrix_scalar,
+    _compose_transformation_matrices,
+    _invert_affine3,
     _rotate_point,
     _get_extent_from_points,
     parse_latex_with_constants
 )
+from .jitutils import dojit
+from .linear_approximation import rdp
 if TYPE_CHECKING:
     from .functionroute import VFRFunctionRoute
 # pylint: enable=wrong-import-position
 
 
+_logger = logging.getLogger(__name__)
+
 OPENWEATHER_ENDPOINT = "https://api.openweathermap.org/data/2.5/forecast" + \
                        "?lat={lat}&lon={lon}&appid={OPENWEATHER_APIKEY}"
 MAGDEV_ENDPOINT = "https://www.ngdc.noaa.gov/geomag-web/calculators/calculateDeclination" + \
@@ -56,11 +65,47 @@ MAGDEV_ENDPOINT = "https://www.ngdc.noaa.gov/geomag-web/calculators/calculateDec
 OPENWEATHER_APIKEY = os.getenv("OPENWEATHER_APIKEY")
 MAGDEV_APIKEY = os.getenv("MAGDEV_APIKEY")
 
+_MISSING = object() # a sentinel for caches where None is a valid cached value
+
+
+@dojit(cache=True)
+def _wind_corrections(headings, speed, wind_speed, wind_dir):
+    """Calculates the wind correction angles of the headings (for when the
+    times of `_wind_corr_and_times` are not needed)."""
+    return np.degrees(np.arcsin(wind_speed/speed*np.sin(np.radians(headings-wind_dir+180))))
+        #FOK(ARCSIN(wind_speed/speed*SIN(RADIÁN(heading-wind_direction+180))))
+
+
+@dojit(cache=True)
+def _wind_corr_and_times(seglens, headings, speed, wind_speed, wind_dir):
+    """Calculates the wind correction angles and the wind-adjusted times of
+    the partitions of a segment. With numba the array expressions are fused
+    into loops without temporary arrays."""
+    corrections = _wind_corrections(headings, speed, wind_speed, wind_dir)
+    speeds_withwind = speed*np.cos(np.radians(-1*corrections)) + \
+                      wind_speed*np.cos(np.radians(headings+corrections-wind_dir+180))
+        #(speed*COS(RADIÁN(-wind_correction)))+
+        #     (wind_speed*
+        #     COS(RADIÁN(heading+wind_correction-wind_direction+180)))
+    return corrections, seglens/1852/speeds_withwind*60
+
+
+def _format_duration(minutes: Optional[float], width: int = 2) -> str:
+    """Formats a segment time (in minutes) as minutes:seconds, the way the
+    map and the document show it ('-:--' if it is not known)."""
+    if minutes is None:
+        return "-:--"
+    mins, secs = divmod(int(minutes*60), 60)
+    return f"{mins:{width}d}:{secs:02d}"
+
 
-class VFRRouteState(Enum):
+class VFRRouteState(IntEnum):
     """A state enumeration of the states (essentially the steps on the
-    frontend) the route can be in.
+    frontend) the route can be in. The states are ordered so they can be
+    compared directly.
     """
+    __str__ = Enum.__str__ # keep 'VFRRouteState.LEGS' in messages instead of '4'
+
     INITIATED = auto()
     AREAOFINTEREST = auto()
     WAYPOINTS = auto()
@@ -80,6 +125,11 @@ class VFRCoordSystem(Enum):
     LONLAT = auto()
 
 
+# a plain dict lookup is cheaper than VFRCoordSystem[name] (which goes through
+# the Enum metaclass) and from_dict does it for every point of a loaded route
+_COORD_SYSTEMS_BY_NAME: dict[str, VFRCoordSystem] = dict(VFRCoordSystem.__members__)
+
+
 class VFRPoint:
     """
     A Point object which knows its coordinate system and coordinates.
@@ -138,7 +188,8 @@ class VFRPoint:
         WARNING: since references were not saved they can be passed to
         this method.
         """
-        return VFRPoint(value['x'], value['y'], VFRCoordSystem[value['coord_system']], route, leg)
+        return VFRPoint(value['x'], value['y'],
+                        _COORD_SYSTEMS_BY_NAME[value['coord_system']], route, leg)
 
 
     def project_point(self, to_system: VFRCoordSystem) -> "VFRPoint":
@@ -151,69 +202,94 @@ class VFRPoint:
                              " you tried to convert to/from function coordinate system.")
         if self.coord_system==to_system:
             return self
-        curx, cury, cursys = self.x, self.y, self.coord_system
-        if self.coord_system.value > to_system.value:
-            if cursys == VFRCoordSystem.LONLAT and cursys.value > to_system.value:
-                if self.route is None:
-                    raise ValueError(
-                        'Cannot convert from LONLAT: no Route is specified')
-                (curx, cury), cursys = self.route.proj(curx, cury), VFRCoordSystem.FULL_WORLD_XY
-            if cursys == VFRCoordSystem.FULL_WORLD_XY and cursys.value > to_system.value:
-                if self.route is None:
-                    raise ValueError(
-                        'Cannot convert from FULL_WORLD_XY: no Route is specified')
-                (curx, cury), cursys = \
-                    _apply_transformation_matrix((curx, cury), self.route.matrix_fullmap2map), \
-                    VFRCoordSystem.MAP_XY
-            if cursys == VFRCoordSystem.MAP_XY and cursys.value > to_system.value:
-                if self.route is None:
-                    raise ValueError(
-                        'Cannot convert from MAP_XY: no Route is specified')
-                (curx, cury), cursys = \
-                    _apply_transformation_matrix((curx, cury), self.route.matrix_map2cropmap), \
-                    VFRCoordSystem.MAPCROP_XY
-            if cursys == VFRCoordSystem.MAPCROP_XY and cursys.value > to_system.value:
-                if self.leg is None:
-                    raise ValueError(
-                        'Cannot convert from MAPCROP_XY: no Leg is specified')
-                (curx, cury), cursys = \
-                    _apply_transformation_matrix((curx, cury), self.leg.matrix_cropmap2func), \
-                    VFRCoordSystem.FUNCTION
-            return VFRPoint(curx, cury, cursys, self.route, self.leg)
+        curx, cury = VFRPoint.project_points_batch(self.x, self.y,
+                                                   self.coord_system, to_system,
+                                                   self.route, self.leg)
+        return VFRPoint(float(curx), float(cury), to_system, self.route, self.leg)
 
-        if cursys == VFRCoordSystem.FUNCTION and cursys.value < to_system.value:
-            if self.leg is None:
-                raise ValueError(
-                    'Cannot convert from FUNCTION: no Route is specified')
-            (curx, cury), cursys = \
-                _apply_transformation_matrix((curx, cury), self.leg.matrix_func2cropmap), \
-                VFRCoordSystem.MAPCROP_XY
-        if cursys == VFRCoordSystem.MAPCROP_XY and cursys.value < to_system.value:
-            if self.route is None:
-                raise ValueError(
-                    'Cannot convert from MAPCROP_XY: no Route is specified')
-            (curx, cury), cursys = \
-                _apply_transformation_matrix((curx, cury), self.route.matrix_cropmap2map), \
-                VFRCoordSystem.MAP_XY
-        if cursys == VFRCoordSystem.MAP_XY and cursys.value < to_system.value:
-            if self.route is None:
+
+    @classmethod
+    def project_points_batch(cls,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                             xs, ys,
+                             from_system: VFRCoordSystem,
+                             to_system: VFRCoordSystem,
+                             route: Optional["VFRFunctionRoute"] = None,
+                             leg: Optional["VFRLeg"] = None
+                            ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Project a set of points (given as coordinate arrays) from one coordinate
+        system to another one without creating a VFRPoint for each of them.
+        The affine steps between the x-y coordinate systems are applied as one
+        pre-composed matrix, only the lon-lat step needs the projection.
+
+        Args
+            xs, ys: array-like
+                The horizontal and vertical coordinates of the points
+            from_system: VFRCoordSystem
+                The coordinate system the points are in
+            to_system: VFRCoordSystem
+                The coordinate system to project the points to
+            route: VFRFunctionRoute
+                The route with the projection parameters
+            leg: VFRLeg
+                The leg with the function projection parameters (neccessary
+                only to/from the function coordinate system)
+
+        Returns
+            A tuple of the projected horizontal and vertical coordinate arrays
+            (for a single point given as scalars they can be plain floats)
+        """
+        if (not leg) and VFRCoordSystem.FUNCTION in [from_system, to_system]:
+            raise ValueError("There is no leg reference defined and" + \
+                             " you tried to convert to/from function coordinate system.")
+        curx, cury = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        cursys = from_system
+        if cursys == to_system:
+            return curx, cury
+        # the lon-lat step is the only non-affine one
+        affine_to = VFRCoordSystem.FULL_WORLD_XY \
+                    if to_system == VFRCoordSystem.LONLAT else to_system
+        if cursys == VFRCoordSystem.LONLAT:
+            if route is None:
                 raise ValueError(
-                    'Cannot convert from MAP_XY: no Route is specified')
-            (curx, cury), cursys = \
-                _apply_transformation_matrix((curx, cury), self.route.matrix_map2fullmap), \
-                VFRCoordSystem.FULL_WORLD_XY
-        if cursys == VFRCoordSystem.FULL_WORLD_XY and cursys.value < to_system.value:
-            if self.route is None:
+                    'Cannot convert from LONLAT: no Route is specified')
+            (curx, cury), cursys = route.proj_fwd(curx, cury), VFRCoordSystem.FULL_WORLD_XY
+        if cursys != affine_to:
+            if VFRCoordSystem.FUNCTION in [cursys, affine_to]:
+                matrix = leg.composed_matrix(cursys, affine_to)
+            else:
+                if route is None:
+                    raise ValueError(
+                        f'Cannot convert from {cursys.name}: no Route is specified')
+                matrix = route.composed_matrix(cursys, affine_to)
+            if np.ndim(curx) == 0: # a single point (see project_point)
+                (curx, cury), cursys = _apply_transformation_matrix_scalar(
+                    float(curx), float(cury), matrix), affine_to
+            else:
+                (curx, cury), cursys = \
+                    _apply_transformation_matrix_batch(curx, cury, matrix), affine_to
+        if cursys != to_system:
+            if route is None:
                 raise ValueError(
                     'Cannot convert from FULL_WORLD_XY: no Route is specified')
-            (curx, cury), cursys = \
-                self.route.proj(curx, cury, inverse=True), \
-                VFRCoordSystem.LONLAT
-        return VFRPoint(curx, cury, cursys, self.route, self.leg)
+            (curx, cury), cursys = route.proj_inv(curx, cury), VFRCoordSystem.LONLAT
+        return curx, cury
+
 
 
+class VFRAnnotationSummary(NamedTuple):
+    """The values of an annotation segment shown on the map and in the documents"""
+    seglen: float
+    segtime: Optional[float]
+    segtime_wind: float
+    heading: float
+    wind_correction: Optional[float]
+    magnetic_deviation: float
+    wind_speed: float
+    wind_dir: float
 
-class VFRAnnotation:
+
+class VFRAnnotation:  # pylint: disable=too-many-public-methods
     """The annotation bubbles the app puts on the map. It defines at which function x
     value it should point to and at what offset from there the bubble should appear.
     """
@@ -230,16 +306,20 @@ class VFRAnnotation:
         """
         """
         self._leg: VFRLeg = leg
-        self.name = name
-        self.x = x
-        self.ofs = ofs
+        self._name = name
+        self._x = x
+        self._ofs = ofs
         self._seglen = None
         self._seglens = None
-        self._segtime = None
+        self._segtime = _MISSING # None is a valid (uncomputable) value
         self._times_withwind = None
         self._weather: Optional[dict] = None
         self._headings = None
         self._declination = None
+        self._sampled_points = None
+        self._wind: Optional[tuple[int, dict[str, float]]] = None # (time of flight, wind)
+        self._summary: Optional[tuple[datetime.datetime, VFRAnnotationSummary]] = None
+        self._index = 0 # the position in the leg's annotations, maintained by the leg
 
 
     def clear_cache(self):
@@ -248,11 +328,45 @@ class VFRAnnotation:
         """
         self._seglen = None
         self._seglens = None
-        self._segtime = None
+        self._segtime = _MISSING # None is a valid (uncomputable) value
         self._times_withwind = None
         self._weather = None
         self._headings = None
         self._declination = None
+        self._sampled_points = None
+        self._wind: Optional[tuple[int, dict[str, float]]] = None # (time of flight, wind)
+        self._summary: Optional[tuple[datetime.datetime, VFRAnnotationSummary]] = None
+
+
+    @property
+    def name(self) -> str:
+        """The text of the annotation bubble"""
+        return self._name
+
+    @name.setter
+    def name(self, name: str):
+        self._name = name
+        self._leg._changed()  # pylint: disable=protected-access
+
+    @property
+    def x(self) -> float:
+        """The function-x value the annotation points to"""
+        return self._x
+
+    @x.setter
+    def x(self, x: float):
+        self._x = x
+        self._leg._changed()  # pylint: disable=protected-access
+
+    @property
+    def ofs(self) -> tuple[float, float]:
+        """The offset of the bubble from the point it points to"""
+        return self._ofs
+
+    @ofs.setter
+    def ofs(self, ofs: tuple[float, float]):
+        self._ofs = ofs
+        self._leg._changed()  # pylint: disable=protected-access
 
 
     def __repr__(self):
@@ -274,23 +388,66 @@ class VFRAnnotation:
         return VFRAnnotation(leg, value['name'], value['x'], value['ofs'])
 
 
+    def _sample(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Samples the segment between the previous and this annotation in 100
+        points and caches them. Returns the function-x, function-y, longitude
+        and latitude arrays of the sample points.
+        """
+        if self._sampled_points is None:
+            x0, x1 = self._leg.ann_start_end(self)
+            x = np.linspace(x0, x1, 100)
+            fx = self._leg.function(x)
+            lon, lat = VFRPoint.project_points_batch(x, fx,
+                                                     VFRCoordSystem.FUNCTION,
+                                                     VFRCoordSystem.LONLAT,
+                                                     self._leg.route, self._leg)
+            self._sampled_points = (x, fx, lon, lat)
+        return self._sampled_points
+
+
+    @classmethod
+    def sample_batch(cls, annotations: list["VFRAnnotation"]):
+        """Samples the segments of several annotations of the same leg with one
+        function evaluation and one projection pass, and fills their sample
+        caches (see `_sample`)."""
+        annotations = [a for a in annotations
+                       if a._sampled_points is None]  # pylint: disable=protected-access
+        if len(annotations) == 0:
+            return
+        leg = annotations[0]._leg  # pylint: disable=protected-access
+        xs = [np.linspace(*leg.ann_start_end(a), 100) for a in annotations]
+        x = np.concatenate(xs)
+        fx = np.broadcast_to(leg.function(x), x.shape)
+        lon, lat = VFRPoint.project_points_batch(x, fx,
+                                                 VFRCoordSystem.FUNCTION,
+                                                 VFRCoordSystem.LONLAT,
+                                                 leg.route, leg)
+        start = 0
+        for a, ax in zip(annotations, xs):
+            end = start + len(ax)
+            a._sampled_points = (ax, fx[start:end],  # pylint: disable=protected-access
+                                 lon[start:end], lat[start:end])
+            start = end
+
+
+    def _calc_geodesics(self):
+        """Calculates the headings and lengths of the partitions of the segment
+        (and the total segment length) with one inverse geodesic calculation."""
+        # calc segment points
+        _, _, lon, lat = self._sample()
+        headings, _, dists = self._leg.route.geod.inv(lon[:-1], lat[:-1], lon[1:], lat[1:])
+        self._headings = np.mod(np.asarray(headings), 360.0)
+        self._seglens = np.asarray(dists)
+        self._seglen = float(self._seglens.sum())
+
+
     @property
     def seglen(self):
         """Calculates and returns the length of the segment between this and the
         previous annotation. It returns the length in kilometers.
         """
-        if self._seglen:
-            return self._seglen
-        x0, x1 = self._leg.ann_start_end(self)
-        # calc segment points
-        x = np.linspace(x0, x1, 100)
-        psrc = [VFRPoint(x,
-                         self._leg.function(x),
-                         VFRCoordSystem.FUNCTION, self._leg.route, self._leg)
-                for x in x]
-        ps = [p.project_point(VFRCoordSystem.LONLAT) for p in psrc]
-        # calc segment length
-        self._seglen = self._leg.route.geod.line_length([p.lon for p in ps], [p.lat for p in ps])
+        if self._seglen is None:
+            self._calc_geodesics()
         return self._seglen
 
 
@@ -300,18 +457,8 @@ class VFRAnnotation:
         the segment between this and the previous annotation. It returns
         the lengths in kilometers.
         """
-        if self._seglens:
-            return self._seglens
-        x0, x1 = self._leg.ann_start_end(self)
-        # calc segment points
-        x = np.linspace(x0, x1, 100)
-        psrc = [VFRPoint(x,
-                         self._leg.function(x),
-                         VFRCoordSystem.FUNCTION, self._leg.route, self._leg)
-                for x in x]
-        ps = [p.project_point(VFRCoordSystem.LONLAT) for p in psrc]
-        # calc segment length
-        self._seglens = self._leg.route.geod.line_lengths([p.lon for p in ps], [p.lat for p in ps])
+        if self._seglens is None:
+            self._calc_geodesics()
         return self._seglens
 
 
@@ -320,7 +467,7 @@ class VFRAnnotation:
         """Calculates the time for the segment between this and the
         previous annotation.
         """
-        if self._segtime:
+        if self._segtime is not _MISSING:
             return self._segtime
         seglen = self.seglen
         self._segtime = seglen/1852/self._leg.route.speed*60 if seglen else None
@@ -332,71 +479,46 @@ class VFRAnnotation:
         """Calculates the time for the segment between this and the
         previous annotation but it is adjusted for wind effects
         """
-        if self._times_withwind:
+        if self._times_withwind is not None:
             return self._times_withwind
-        headings = [h if h>=0 else h+360 for h in self.headings]
-        wind_corrections = self.wind_corrections()
-        speeds_withwind = [(self._leg.route.speed*math.cos(
-                                math.radians(-1*wind_corrections[i]))) + \
-                           (self.wind_speed*math.cos(
-                               math.radians(headings[i]+wind_corrections[i]-
-                                            self.wind_dir+180)))
-                           for i in range(len(headings))]
-                          #(speed*COS(RADIÁN(-wind_correction)))+
-                          #     (wind_speed*
-                          #     COS(RADIÁN(heading+wind_correction-wind_direction+180)))
-        self._times_withwind = [self.seglens[i]/1852/speeds_withwind[i]*60
-                                for i in range(len(self.seglens))]
+        _, self._times_withwind = _wind_corr_and_times(np.asarray(self.seglens, dtype=float),
+                                                       np.asarray(self.headings, dtype=float),
+                                                       float(self._leg.route.speed),
+                                                       float(self.wind_speed),
+                                                       float(self.wind_dir))
         return self._times_withwind
 
 
 
     @property
-    def headings(self) -> list[float]:
+    def headings(self) -> np.ndarray:
         """Returns a list of headings of 100 points of the segment from previous annotiation
         to this one."""
-        if self._headings:
-            return self._headings
-        x0, x1 = self._leg.ann_start_end(self)
-        x = np.linspace(x0, x1, 100)
-        psrc = [VFRPoint(x,
-                         self._leg.function(x),
-                         VFRCoordSystem.FUNCTION, self._leg.route, self._leg)
-                for x in x]
-        ps = [p.project_point(VFRCoordSystem.LONLAT) for p in psrc]
-        lat = [p.lat for p in ps]
-        lon = [p.lon for p in ps]
-        headings, _, _ = self._leg.route.geod.inv(lon[:-1], lat[:-1], lon[1:], lat[1:])
-        def clamp(deg):
-            while deg>360:
-                deg-=360
-            while deg<0:
-                deg+=360
-            return deg
-        headings = [clamp(h) for h in headings]
-        self._headings = headings
+        if self._headings is None:
+            self._calc_geodesics()
         return self._headings
 
 
+    @property
+    def lonlat_point(self) -> VFRPoint:
+        """The point of the leg this annotation points to (in lon-lat)."""
+        return VFRPoint(self.x,
+                        self._leg.function(self.x),
+                        VFRCoordSystem.FUNCTION, self._leg.route, self._leg) \
+               .project_point(VFRCoordSystem.LONLAT)
+
+
     def get_weather(self):
         """Downloads and caches the weather forecast. Gets either a sample weather
         forecast (for quick editing) or real one from OpenWeather"""
         # only download once
-        if not self._weather:
+        if self._weather is None:
             # download weather at from point
             if self.ALWAYS_USE_REAL_WEATHER or \
                     self._leg.route.use_realtime_data:
                         # either forced by settings or requested by user (situation)
-                p = VFRPoint(self.x,
-                             self._leg.function(self.x),
-                             VFRCoordSystem.FUNCTION, self._leg.route, self._leg)
-                p = p.project_point(VFRCoordSystem.LONLAT)
-                response = self._leg.route.session.get(OPENWEATHER_ENDPOINT.format(
-                    lon=p.lon,
-                    lat=p.lat,
-                    OPENWEATHER_APIKEY=OPENWEATHER_APIKEY
-                ))
-                self._weather = response.json()
+                p = self.lonlat_point
+                self._weather = self._leg.route.realtime_data.get_weather_at(p.lon, p.lat)
             else:
                 with open(os.path.join(Path(__file__).parent,
                                        'sample_weather.json'),
@@ -405,32 +527,24 @@ class VFRAnnotation:
                     self._weather = json.load(f)
 
 
-    def magnetic_deviation(self, when=datetime.datetime.now()):
+    def magnetic_deviation(self, when: Optional[datetime.datetime] = None):
         """Downloads and caches the magnetic deviation for the annotation
         point. Gets either a fix value (for quick route editing) or real one
         from www.ngdc.noaa.gov"""
-        if self._declination:
+        if self._declination is not None:
             return self._declination
+        when = when or datetime.datetime.now()
         try:
             if self.ALWAYS_USE_REAL_WEATHER or \
                     self._leg.route.use_realtime_data:
                     # either forced by settings or requested by user (situation)
-                p = VFRPoint(self.x,
-                             self._leg.function(self.x),
-                             VFRCoordSystem.FUNCTION, self._leg.route, self._leg)
-                p = p.project_point(VFRCoordSystem.LONLAT)
-                api_res = self._leg.route.session.get(MAGDEV_ENDPOINT.format(
-                    lon = p.lon,
-                    lat = p.lat,
-                    MAGDEV_APIKEY = MAGDEV_APIKEY,
-                    when = when
-                ))
-                api_res = api_res.json()
-                self._declination = api_res["result"][0]["declination"]
+                p = self.lonlat_point
+                self._declination = self._leg.route.realtime_data.get_declination_at(p.lon, p.lat,
+                                                                                   when)
             else:
                 self._declination = 6
         except Exception:  # pylint: disable=broad-exception-caught
-            traceback.print_exc()
+            _logger.exception("Could not get the magnetic declination, using a default")
             self._declination = 5
         return self._declination
 
@@ -447,16 +561,21 @@ class VFRAnnotation:
                 "gust": 0
             }
         weather_ts = int(self._leg.route.dof.timestamp())
-        latest = sorted((wfx
-                         for wfx in self._weather['list']
-                         if wfx['dt']<=weather_ts),
-                        key=lambda wfx: wfx['dt'])
-        if len(latest)<1:
+        # the time of flight can change, so the cached value is only valid for one
+        if self._wind is not None and self._wind[0] == weather_ts:
+            return self._wind[1]
+        latest = max((wfx
+                      for wfx in self._weather['list']
+                      if wfx['dt']<=weather_ts),
+                     key=lambda wfx: wfx['dt'],
+                     default=None)
+        if latest is None:
             raise ValueError(
                 "No wind forecast is available for that date/time" + \
                 f" ({self._leg.route.dof.isoformat()})"
             )
-        return latest[-1]['wind']
+        self._wind = (weather_ts, latest['wind'])
+        return self._wind[1]
 
 
     @property
@@ -474,21 +593,45 @@ class VFRAnnotation:
     def wind_corrections(self,
                          speed: Optional[float] = None,
                          headings: Optional[list[float]] = None
-                        ) -> list[float]:
+                        ) -> np.ndarray:
         """Gets the Wind Correction Angle for the list of headings given in argument
         or calculated for 100 pointsbetween this and the previous annotation point."""
         if not speed:
             speed = self._leg.route.speed
-        if not headings:
+        if headings is None:
             headings = self.headings
-        return [math.degrees(
-                    math.asin(self.wind_speed/self._leg.route.speed*
-                              math.sin(math.radians(h-self.wind_dir+180))))
-                for h in headings]
-               #FOK(ARCSIN(wind_speed/speed*SIN(RADIÁN(heading-wind_direction+180))))
+        headings = np.asarray(headings, dtype=float)
+        return _wind_corrections(headings,
+                                 float(speed),
+                                 float(self.wind_speed),
+                                 float(self.wind_dir))
 
 
 
+    def summary(self, when: Optional[datetime.datetime] = None) -> VFRAnnotationSummary:
+        """Collects (and caches) all values of the segment between the previous
+        and this annotation we show, so the map and the document use the same
+        results. `when` is the time of the flight (for the magnetic deviation)."""
+        when = when or self._leg.route.dof
+        if self._summary is not None and self._summary[0] == when:
+            return self._summary[1]
+        seghdgs = self.headings
+        # only the correction at the end of the segment is shown
+        wind_corrs = self.wind_corrections(headings=seghdgs[-1:])
+        summary = VFRAnnotationSummary(
+            seglen=self.seglen,
+            segtime=self.segtime,
+            segtime_wind=sum(self.times_withwind),
+            heading=seghdgs[-1],
+            wind_correction=wind_corrs[-1] if len(wind_corrs) else None,
+            magnetic_deviation=self.magnetic_deviation(when),
+            wind_speed=self.wind_speed,
+            wind_dir=self.wind_dir
+        )
+        self._summary = (when, summary)
+        return summary
+
+
     def draw(self, ax: matplotlib.axes.Axes):
         """Draws the annotation bubble on a MatPlotLib Figure."""
         start = time.perf_counter_ns()
@@ -496,25 +639,21 @@ class VFRAnnotation:
                       self._leg.function(self.x),
                       VFRCoordSystem.FUNCTION, self._leg.route, self._leg) \
                       .project_point(VFRCoordSystem.MAPCROP_XY)
-        seglen = self.seglen
-        segtime = self.segtime if self.segtime is not None else 0
-        segtime_wind = sum(self.times_withwind)
-        segtime_wind = segtime_wind if segtime_wind is not None else 0
-        seghdgs = self.headings
-        wind_corrs = self.wind_corrections(headings=seghdgs)
-        wind_corr = wind_corrs[-1] if wind_corrs else None
-        mag_dev = self.magnetic_deviation(self._leg.route.dof)
-        s_seglen = f"\ndist: {seglen/1852:.1f}NM\ntime: {math.floor(segtime):3d}:" + \
-                   f"{math.floor((segtime-math.floor(segtime))*60):02d}" + \
-                   f" / {math.floor(segtime_wind):3d}:" + \
-                   f"{math.floor((segtime_wind-math.floor(segtime_wind))*60):02d}"
-        if self._leg.annotations.index(self) == 0:
+        summary = self.summary(self._leg.route.dof)
+        seglen = summary.seglen
+        segtime = summary.segtime if summary.segtime is not None else 0
+        segtime_wind = summary.segtime_wind if summary.segtime_wind is not None else 0
+        wind_corr = summary.wind_correction
+        mag_dev = summary.magnetic_deviation
+        s_seglen = f"\ndist: {seglen/1852:.1f}NM\ntime: {_format_duration(segtime, 3)}" + \
+                   f" / {_format_duration(segtime_wind, 3)}"
+        if self._index == 0:
             s_seglen = ""
         calc_time = time.perf_counter_ns() - start
 
         ann = ax.annotate( # pylint: disable=unused-variable
-            f'{self.name}\ntrack: ${self.headings[-1]:.0f}\\degree${mag_dev:+.0f}(M)' + \
-            f'{wind_corr:+.0f}(W:{self.wind_speed:.0f}/{self.wind_dir:.0f}){s_seglen}',
+            f'{self.name}\ntrack: ${summary.heading:.0f}\\degree${mag_dev:+.0f}(M)' + \
+            f'{wind_corr:+.0f}(W:{summary.wind_speed:.0f}/{summary.wind_dir:.0f}){s_seglen}',
             xy=(xy.x, xy.y), xycoords='data',
             xytext=(self.ofs[0], self.ofs[1]), textcoords='offset points',
             size=5.5, va="center",
@@ -531,7 +670,19 @@ class VFRAnnotation:
         return calc_time
 
 
-class VFRLeg:
+@lru_cache(maxsize=128)
+def _lambdify_function(function_name: str):
+    """Converts a LaTeX string into a numpy-vectorized Python function.
+    The result is cached per LaTeX string as parsing and lambdifying is slow."""
+    parsedfun = parse_latex_with_constants(function_name) # parse_latex(latex)
+    if not parsedfun.free_symbols:
+        # constant function: lambdify would return a scalar for an array input
+        value = float(parsedfun)
+        return lambda x: np.full(np.shape(x), value) if np.ndim(x) else value
+    return lambdify(sympy.abc.x, parsedfun, modules="numpy")
+
+
+class VFRLeg:  # pylint: disable=too-many-instance-attributes
     """A class representing a Leg of the Route. It defines the starting and ending point
     of the Leg (lon-lat), the function (like `sin(x)`) the Leg must follow, and optional
     constraint point(s) to adjust the curve of the Leg slightly.
@@ -546,17 +697,16 @@ class VFRLeg:
         """
         """
         self._route: "VFRFunctionRoute" = route
-        self.name = name
-        self.function_name = function_name
+        self._name = name
+        self._function_name = function_name
         self.calc_function()
-        self.function_range = function_range
+        self._function_range = function_range
         self.points = points
-        for p, _ in self.points:
-            p.leg = self
-        self.annotations: list[VFRAnnotation] = []
+        self.annotations = []
 
         self._matrix_func2cropmap = None
         self._matrix_cropmap2func = None
+        self._composed_matrices: dict[tuple[VFRCoordSystem, VFRCoordSystem], np.ndarray] = {}
 
         self.color="red"
         self.lw=2
@@ -568,15 +718,91 @@ class VFRLeg:
         """
         self._route.ensure_state(VFRRouteState.LEGS)
         newannotation = VFRAnnotation(self, name, x, ofs)
-        self.annotations.append(newannotation)
+        newannotation._index = len(self._annotations)  # pylint: disable=protected-access
+        self._annotations.append(newannotation)
+        self._changed()
         return self
 
 
+    def _changed(self):
+        """Private helper to note that the content of the leg (so of the
+        route) changed, it invalidates the cached serialized forms of the route."""
+        if self._route is not None:
+            self._route._changed()  # pylint: disable=protected-access
+
+
     @property
     def route(self):
         """A read-only accessor to the parent route"""
         return self._route
 
+    @property
+    def name(self) -> str:
+        """The name of the Leg"""
+        return self._name
+
+    @name.setter
+    def name(self, name: str):
+        self._name = name
+        self._changed()
+
+    @property
+    def function_name(self) -> str:
+        """The (LaTeX) function the Leg follows"""
+        return self._function_name
+
+    @function_name.setter
+    def function_name(self, function_name: str):
+        self._function_name = function_name
+        self._changed()
+
+    @property
+    def function_range(self) -> str:
+        """The (LaTeX) description of the function range"""
+        return self._function_range
+
+    @function_range.setter
+    def function_range(self, function_range: str):
+        self._function_range = function_range
+        self._changed()
+
+    @property
+    def points(self) -> list[tuple[VFRPoint, float]]:
+        """The (lon-lat) points the Leg goes through with their function-x values"""
+        return self._points
+
+    @points.setter
+    def points(self, points: list[tuple[VFRPoint, float]]):
+        """Sets the points of the Leg and keeps the function-x values in a
+        parallel array, too."""
+        self._points = points
+        for p, _ in self._points:
+            p.leg = self
+        self._x = np.array([x for _, x in points], dtype=float)
+        self._changed()
+
+    def _points_lonlat(self) -> np.ndarray:
+        """Private helper to get the lon-lat coordinates of the points as an
+        (N, 2) array. It is built from the points on every call (a point can be
+        changed in place), and the points not in lon-lat are projected."""
+        return np.array([(p.lon, p.lat)
+                         for p in (pt.project_point(VFRCoordSystem.LONLAT)
+                                   for pt, _ in self._points)],
+                        dtype=float).reshape(-1, 2)
+
+    @property
+    def annotations(self) -> list[VFRAnnotation]:
+        """The annotations of the Leg (in order)"""
+        return self._annotations
+
+    @annotations.setter
+    def annotations(self, annotations: list[VFRAnnotation]):
+        """Sets the annotations of the Leg and tells each one its position."""
+        self._annotations = annotations
+        for i, ann in enumerate(self._annotations):
+            ann._index = i  # pylint: disable=protected-access
+        self._changed()
+
     @property
     def matrix_cropmap2func(self):
         """A read-only accessor to the inverse transformation matrix"""
@@ -588,28 +814,75 @@ class VFRLeg:
         return self._matrix_func2cropmap
 
 
+    def composed_matrix(self,
+                        from_system: VFRCoordSystem,
+                        to_system: VFRCoordSystem) -> np.ndarray:
+        """Get the (pre-composed) transformation matrix between the function
+        coordinate system and one of the map coordinate systems."""
+        return self._composed_matrices[(from_system, to_system)]
+
+
     def get_extent(self) -> ExtentLonLat:
         """Get the extent of the Leg in terms of min-(lon-lat)/max-(lon-lat)
         taking into consideration the curvature of the function."""
-        x = np.linspace(min(x for p, x in self.points),
-                        max(x for p, x in self.points),
-                        100
-                       )
+        x = np.linspace(self._x.min(), self._x.max(), 100)
         if not hasattr(self, '_matrix_cropmap2func') or self._matrix_cropmap2func is None:
             self.calc_transformations()
         if not self.function:
             self.calc_function()
-        psrc = [VFRPoint(x,
-                         self.function(x),
-                         VFRCoordSystem.FUNCTION, self._route, self)
-                for x in x]
-        ps = [p.project_point(VFRCoordSystem.LONLAT) for p in psrc]
-        pll = [PointLonLat(p.lon, p.lat) for p in ps] + \
-              [PointLonLat(p.lon, p.lat) for p, x in self.points]
+        lon, lat = VFRPoint.project_points_batch(x, self.function(x),
+                                                 VFRCoordSystem.FUNCTION, VFRCoordSystem.LONLAT,
+                                                 self._route, self)
+        pll = np.concatenate((np.column_stack((lon, lat)), self._points_lonlat()))
         return _get_extent_from_points(pll)
 
 
-    def draw(self, ax, with_annotations: bool = True):
+    def calc_track_points(self, with_annotations: bool = True) -> tuple[np.ndarray, np.ndarray]:
+        """Calculate the points of the planned track in map coordinates (and
+        optionally the geometry of the annotation segments) without touching
+        any MatPlotLib objects, so the legs of a route can be prepared in
+        parallel threads.
+
+        Args
+            with_annotations: bool
+                Wether to also prepare the annotation segments (defaults to True)
+
+        Returns
+            A tuple of the horizontal and vertical MAPCROP_XY coordinate arrays
+        """
+        x = np.linspace(self._x.min(), self._x.max(), 100)
+        if not hasattr(self, '_matrix_cropmap2func') or self._matrix_cropmap2func is None:
+            self.calc_transformations()
+        if not self.function:
+            self.calc_function()
+        track = VFRPoint.project_points_batch(x, self.function(x),
+                                              VFRCoordSystem.FUNCTION, VFRCoordSystem.MAPCROP_XY,
+                                              self._route, self)
+        if with_annotations:
+            VFRAnnotation.sample_batch(self.annotations)
+            for a in self.annotations:
+                _ = a.headings # calculates and caches the geodesics
+        return track
+
+
+    def calc_plan_points(self) -> tuple[np.ndarray, np.ndarray]:
+        """Approximate the leg with straight lines for the flight plan (the
+        functions slow down the flight planning apps). Like `calc_track_points`
+        it does not touch shared objects, so the legs can be done in parallel.
+
+        Returns
+            A tuple of the longitude and latitude arrays of the breakpoints
+        """
+        x = np.linspace(self._x.min(), self._x.max(), 500)
+        breakpoints = rdp(np.column_stack((x, self.function(x))), 0.025)
+        return VFRPoint.project_points_batch(breakpoints[:, 0], breakpoints[:, 1],
+                                             VFRCoordSystem.FUNCTION, VFRCoordSystem.LONLAT,
+                                             self._route, self)
+
+
+    def draw(self, ax,
+             with_annotations: bool = True,
+             track: Optional[tuple[np.ndarray, np.ndarray]] = None):
         """Draw the leg on a MatPlotLib Figure considering the function curvature,
         the projection of the points from lon-lat to map coordinates and transforming
         the function into map coordinates.
@@ -619,42 +892,41 @@ class VFRLeg:
                 A MatPlotLib Axes object to draw on
             with_annotations: bool
                 Wether to also draw the annotation bubbles (defaults to True)
+            track: tuple[np.ndarray, np.ndarray]
+                The result of `calc_track_points` if it was already called
         """
         # draw planned track
-        x = np.linspace(min(x for p, x in self.points),
-                        max(x for p, x in self.points),
-                        100
-                       )
-        if not hasattr(self, '_matrix_cropmap2func') or self._matrix_cropmap2func is None:
-            self.calc_transformations()
-        if not self.function:
-            self.calc_function()
-        psrc = [VFRPoint(x,
-                         self.function(x),
-                         VFRCoordSystem.FUNCTION, self._route, self)
-                for x in x]
-        ps = [p.project_point(VFRCoordSystem.MAPCROP_XY) for p in psrc]
-        ax.plot([p.x for p in ps],
-                [p.y for p in ps],
+        if track is None:
+            track = self.calc_track_points(with_annotations)
+        px, py = track
+        ax.plot(px,
+                py,
                 color=self.color,
                 lw=self.lw
                )
         # draw annotations
         calc_time = 0
         if with_annotations:
-            for a in self.annotations:
-                calc_time += a.draw(ax)
+            calc_time = self.draw_annotations(ax)
 
         return calc_time
 
 
+    def draw_annotations(self, ax) -> int:
+        """Draw only the annotation bubbles of the leg on a MatPlotLib Figure
+        and return the time spent on their calculations."""
+        calc_time = 0
+        for a in self.annotations:
+            calc_time += a.draw(ax)
+        return calc_time
+
+
     def calc_function(self):
         """Converts a LaTeX string (user input) into a Python lambda
         function (calculation basis).
         On conversion error it falls back to the identity function."""
         try:
-            parsedfun = parse_latex_with_constants(self.function_name) # parse_latex(latex)
-            self.function = lambdify(sympy.abc.x, parsedfun, modules=["math"])
+            self.function = _lambdify_function(self.function_name)
         except Exception:  # pylint: disable=broad-exception-caught
             self.function = lambda x: x # fallback to linear
 
@@ -665,17 +937,35 @@ class VFRLeg:
         constraint points. Gives a best approximation.
         """
         self.calc_function()
-        sp = [PointXY(x, self.function(x)) for (p, x) in self.points]
-        dpp = [p.project_point(VFRCoordSystem.MAPCROP_XY) for p, x in self.points]
-        dp = [PointXY(p.x, p.y) for p in dpp]
+        fx = np.broadcast_to(self.function(self._x), self._x.shape)
+        sp = [PointXY(x, y) for x, y in zip(self._x.tolist(), fx.tolist())]
+        lonlat = self._points_lonlat()
+        dx, dy = VFRPoint.project_points_batch(lonlat[:, 0], lonlat[:, 1],
+                                               VFRCoordSystem.LONLAT, VFRCoordSystem.MAPCROP_XY,
+                                               self._route)
+        dp = [PointXY(x, y) for x, y in zip(dx.tolist(), dy.tolist())]
         if len(sp) < 3:
             sp.append(_rotate_point(sp[0], sp[1], -90))
             dp.append(_rotate_point(dp[0], dp[1], 90))
         try:
             self._matrix_func2cropmap = _calculate_2d_transformation_matrix(sp, dp)
-            self._matrix_cropmap2func = np.linalg.inv(self._matrix_func2cropmap)
+            self._matrix_cropmap2func = _invert_affine3(self._matrix_func2cropmap)
         except Exception: # pylint: disable=broad-exception-caught
             pass # keep the old matrix
+        if self._matrix_func2cropmap is None:
+            return
+        # pre-compose the matrices of the multi-step transformations
+        func, crop, mapxy, full = VFRCoordSystem.FUNCTION, VFRCoordSystem.MAPCROP_XY, \
+                                  VFRCoordSystem.MAP_XY, VFRCoordSystem.FULL_WORLD_XY
+        self._composed_matrices = {
+            (func, crop): self._matrix_func2cropmap,
+            (crop, func): self._matrix_cropmap2func,
+        }
+        for other in [mapxy, full]:
+            self._composed_matrices[(func, other)] = _compose_transformation_matrices(
+                self._matrix_func2cropmap, self._route.composed_matrix(crop, other))
+            self._composed_matrices[(other, func)] = _compose_transformation_matrices(
+                self._route.composed_matrix(other, crop), self._matrix_cropmap2func)
 
 
     def ann_start_end(self, ann: VFRAnnotation) -> tuple[float, float]:
@@ -685,7 +975,7 @@ class VFRLeg:
         by a small amount (good for the heading calculations).
         """
         # calc start and end x
-        i = self.annotations.index(ann)
+        i = ann._index  # pylint: disable=protected-access
         x1 = self.annotations[i].x
         if i > 0:
             x0 = self.annotations[i-1].x
@@ -722,12 +1012,33 @@ class VFRLeg:
         return s
 
 
+class VFRPointArrayView(Sequence):
+    """A read-only list-like view of lon-lat points stored in an (N, 2) array.
+    The VFRPoint objects are only created when an item is accessed.
+    """
+
+    def __init__(self, lonlat: np.ndarray, route: Optional["VFRFunctionRoute"] = None):
+        self._lonlat = lonlat
+        self._route = route
+
+    def __len__(self):
+        return self._lonlat.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        lon, lat = self._lonlat[idx].tolist()
+        return VFRPoint(lon, lat, VFRCoordSystem.LONLAT, self._route)
+
+
 class VFRTrack:
     """A class representing a Track on the Route (i.e. an actually flown path).
     It is initialized from a .GPX file or a GPX string, defines the color with
     which it will be drawn onto the map.
     """
 
+    GPX_NAMESPACE = "http://www.topografix.com/GPX/1/1"
+
     def __init__(self,
                  route: "VFRFunctionRoute",
                  fname: Union[str, Path],
@@ -738,46 +1049,64 @@ class VFRTrack:
         self._route = route
         self.fname = fname
         self.color = color
-        self.points: list[VFRPoint] = []
+        self._lonlat = np.empty((0, 2))
         if load:
-            self.points=self.read_gpx(fname=fname, xmlb=xmlb)
+            self._lonlat = self.read_gpx(fname=fname, xmlb=xmlb)
+
+    @property
+    def points(self) -> VFRPointArrayView:
+        """The points of the track (lon-lat VFRPoints created on access)"""
+        return VFRPointArrayView(self._lonlat, self._route)
+
+    @points.setter
+    def points(self, points: Sequence[VFRPoint]):
+        """Sets the points of the track (stored as an (N, 2) lon-lat array)"""
+        self._lonlat = np.array([(p.lon, p.lat) for p in points], dtype=float).reshape(-1, 2)
 
     def read_gpx(self,
                  fname: str | Path | None = None,
                  xmlb: Optional[bytes] = None
-                ) -> list[VFRPoint]:
-        """Reads flown points from a GPX file / GPX string"""
-        if xmlb:
-            plangpx = etree.fromstring(xmlb)
-        else:
-            plangpx = etree.parse(fname)
-        ns = {"gpx": "http://www.topografix.com/GPX/1/1",
-              "geotracker": "http://ilyabogdanovich.com/gpx/extensions/geotracker"}
-        planptx = plangpx.xpath("/gpx:gpx/gpx:trk/gpx:trkseg/gpx:trkpt", namespaces=ns)
-        planpts: list[VFRPoint] = []
-        for _, ptx in enumerate(planptx):
-            lon = float(ptx.get('lon'))
-            lat = float(ptx.get('lat'))
-            planpts.append(
-                VFRPoint(lon, lat, VFRCoordSystem.LONLAT, self._route)
-            )
-        return planpts
+                ) -> np.ndarray:
+        """Reads flown points from a GPX file / GPX string into an (N, 2)
+        lon-lat array. The file is streamed so memory use does not grow with
+        the document tree."""
+        source = io.BytesIO(xmlb) if xmlb else fname
+        lons, lats = array.array('d'), array.array('d')
+        for _, ptx in etree.iterparse(source, events=('end',),
+                                      tag=f"{{{self.GPX_NAMESPACE}}}trkpt"):
+            lons.append(float(ptx.get('lon')))
+            lats.append(float(ptx.get('lat')))
+            # free the already processed elements
+            ptx.clear()
+            while ptx.getprevious() is not None:
+                del ptx.getparent()[0]
+        return np.column_stack((np.frombuffer(lons, dtype=float),
+                                np.frombuffer(lats, dtype=float)))
+
+    def calc_track_points(self) -> tuple[np.ndarray, np.ndarray]:
+        """Calculate the points of the track in map coordinates"""
+        return VFRPoint.project_points_batch(self._lonlat[:, 0], self._lonlat[:, 1],
+                                             VFRCoordSystem.LONLAT, VFRCoordSystem.MAPCROP_XY,
+                                             self._route)
 
     def draw(self, ax: matplotlib.axes.Axes):
         """Draw track on a MatPlotLib Figure"""
-        ps = [p.project_point(VFRCoordSystem.MAPCROP_XY) for p in self.points]
-        ax.plot([p.x for p in ps],
-                [p.y for p in ps],
+        px, py = self.calc_track_points()
+        ax.plot(px,
+                py,
                 color=self.color,
                 lw=2
                )
 
     def to_dict(self):
         """Convert the object to a serializable dictionary"""
+        # straight from the array (the same as VFRPoint.to_dict, without the objects)
+        coord_system = VFRCoordSystem.LONLAT.name
         return {
             'name': self.fname,
             'color': self.color,
-            'points': [p.to_dict() for p in self.points]
+            'points': [{'x': lon, 'y': lat, 'coord_system': coord_system}
+                       for lon, lat in self._lonlat.tolist()]
         }
 
     @classmethod
@@ -789,4 +1118,4 @@ class VFRTrack:
 
     def get_extent(self):
         """Get the extent of the track by enumerating its points"""
-        return _get_extent_from_points([PointLonLat(p.lon, p.lat) for p in self.points])
+        return _get_extent_from_points(self._lonlat)
@@ -1,17 +1,8 @@
 """Fast, memory-efficient Image compositing on numpy arrays
 """
-import os
 import numpy as np
 
-USE_NUMBA = os.getenv('USE_NUMBA', 'True').lower() in ['true', 'yes', '1', 'on']
-
-if USE_NUMBA:
-    from numba import njit
-    dojit = njit
-else:
-    def dojit(func):
-        """no-op decorator"""
-        return func
+from .jitutils import dojit
 
 
 @dojit
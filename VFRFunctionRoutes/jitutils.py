@@ -0,0 +1,15 @@
+"""Optional JIT compilation of numeric kernels with numba
+"""
+import os
+
+USE_NUMBA = os.getenv('USE_NUMBA', 'True').lower() in ['true', 'yes', '1', 'on']
+
+if USE_NUMBA:
+    from numba import njit
+    dojit = njit
+else:
+    def dojit(func=None, **_kwargs):
+        """no-op decorator (can be used with or without arguments, like njit)"""
+        if func is None:
+            return lambda f: f
+        return func
@@ -1,7 +1,9 @@
 """Helper functions to best linear approximation of an arbitrary function
 """
+import math
 import numpy as np
-import matplotlib.pyplot as plt
+
+from .jitutils import dojit
 
 
 ##########################
@@ -18,19 +20,42 @@ def rdp(points, epsilon):
     points: Nx2 numpy array of [x, y] points
     epsilon: max allowed error (tolerance)
     """
-    start, end = points[0], points[-1]
-    dmax, index = 0, 0
-    for i in range(1, len(points) - 1):
-        d = perpendicular_distance(points[i], start, end)
-        if d > dmax:
-            index, dmax = i, d
-
-    if dmax > epsilon:
-        left = rdp(points[:index+1], epsilon)
-        right = rdp(points[index:], epsilon)
-        return np.vstack((left[:-1], right))
-
-    return np.array([start, end])
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    return points[_rdp_keep(points, float(epsilon))]
+
+
+@dojit(cache=True)
+def _rdp_keep(points, epsilon):
+    """The compiled kernel of `rdp`: the recursion is replaced by a stack of
+    (start, end) index pairs. Returns the mask of the points to keep."""
+    n = points.shape[0]
+    keep = np.zeros(n, dtype=np.bool_)
+    keep[0] = True
+    keep[n-1] = True
+    starts = np.empty(n, dtype=np.int64)
+    ends = np.empty(n, dtype=np.int64)
+    starts[0], ends[0], top = 0, n-1, 1
+    while top > 0:
+        top -= 1
+        start, end = starts[top], ends[top]
+        sx, sy = points[start, 0], points[start, 1]
+        dx, dy = points[end, 0] - sx, points[end, 1] - sy
+        length = math.sqrt(dx*dx + dy*dy)
+        dmax, index = 0., 0
+        for i in range(start+1, end):
+            px, py = points[i, 0], points[i, 1]
+            if length == 0.:
+                d = math.sqrt((px-sx)*(px-sx) + (py-sy)*(py-sy))
+            else:
+                d = abs(dx*(sy-py) - dy*(sx-px)) / length
+            if d > dmax:
+                index, dmax = i, d
+        if dmax > epsilon:
+            keep[index] = True
+            starts[top], ends[top] = start, index
+            starts[top+1], ends[top+1] = index, end
+            top += 2
+    return keep
 
 
 def fit_segments(points, breakpoints):
@@ -119,6 +144,7 @@ def piecewise_linear_fit(x, y, num_segments):
 #####################
 def example_rdp():
     """An example usage of the RDP algorithm"""
+    import matplotlib.pyplot as plt  # pylint: disable=import-outside-toplevel
     # ---- Example usage ----
     f = np.sin
     x = np.linspace(0, 2*np.pi, 500)
@@ -141,6 +167,7 @@ def example_rdp():
 
 def example_dp():
     """An example usage of the DP algorithm"""
+    import matplotlib.pyplot as plt  # pylint: disable=import-outside-toplevel
     # ---- Example usage ----
     f = np.sin
     x = np.linspace(0, 2*np.pi, 200)
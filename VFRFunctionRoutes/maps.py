@@ -2,10 +2,10 @@
 Map managing utilities
 """
 import os
-import io
+import hashlib
+import tempfile
 from typing import Optional, Union
 import json
-from matplotlib.markers import MarkerStyle
 import requests
 
 # pdf and imaging related packages
@@ -14,12 +14,10 @@ import PIL
 import matplotlib
 matplotlib.use("Agg")
 # pylint: disable=wrong-import-position
-import matplotlib.pyplot as plt
-from matplotlib.backend_bases import MouseButton
 import numpy as np
 
 from .projutils import PointLonLat, PointXY
-from .rendering import SimpleRect, TileRenderer
+from .rendering import SimpleRect, TileRenderer, _locked_pdf_document, _pixmap_to_pil
 from .remote_cache import IRemoteCache
 # pylint: enable=wrong-import-position
 
@@ -112,6 +110,12 @@ class MapManager:
     A Manager class for the maps available in the app (defined in a json file in maps/ folder)
     """
     _instance: Optional['MapManager'] = None
+    # the rendered pages of the clickers are cached outside the data folder,
+    # only the most recently used ones are kept
+    PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR",
+                               os.path.join(tempfile.gettempdir(), "vfr_pagecache"))
+    PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "4")) # number of pages kept
+
     def __init__(self,
                  dpis: list[int],
                  request_session: requests.Session,
@@ -172,6 +176,44 @@ class MapManager:
         return curmap.get_tilerenderer(dpi)
 
 
+    @staticmethod
+    def render_pdf_page(pdf_path: str,
+                        clip: Optional[tuple[float, float, float, float]] = None,
+                        dpi: int = 72
+                       ) -> PIL.Image:  # type: ignore
+        """Render the first page of a PDF (or a clip of it) into an image.
+        The result is cached in `PAGE_CACHE_DIR`, keyed by the PDF and its
+        modification time, the resolution and the clip, so re-entering the
+        clickers is instant.
+        """
+        key = repr((os.path.abspath(pdf_path), os.path.getmtime(pdf_path), dpi, clip))
+        cache_fname = os.path.join(
+            MapManager.PAGE_CACHE_DIR,
+            f"pagecache_{os.path.splitext(os.path.basename(pdf_path))[0]}_"
+            f"{hashlib.sha1(key.encode('utf8')).hexdigest()}.png")
+        # check local cache
+        if os.path.isfile(cache_fname):
+            os.utime(cache_fname) # recently used
+            with PIL.Image.open(cache_fname) as cached:  # type: ignore
+                return cached.copy() # loaded, the file is not kept open
+        # render
+        with _locked_pdf_document(pdf_path) as pdf_document:
+            pixmap: pymupdf.Pixmap = pdf_document[0].get_pixmap(  # type: ignore
+                clip=pymupdf.Rect(*clip) if clip is not None else None,
+                dpi=dpi)
+        pdfimg = _pixmap_to_pil(pixmap)
+        # save it (fast compression, the high resolution pages are big) and
+        # drop the least recently used pages
+        os.makedirs(MapManager.PAGE_CACHE_DIR, exist_ok=True)
+        pdfimg.save(cache_fname, compress_level=1)
+        cached_pages = sorted((e for e in os.scandir(MapManager.PAGE_CACHE_DIR)
+                               if e.name.startswith("pagecache_") and e.name.endswith(".png")),
+                              key=lambda e: e.stat().st_mtime, reverse=True)
+        for entry in cached_pages[MapManager.PAGE_CACHE_SIZE:]:
+            os.remove(entry.path)
+        return pdfimg
+
+
     @staticmethod
     def map_areaselect_lowres(pdf_path: str,  # pylint: disable=too-many-statements
                               area: SimpleRect,
@@ -180,13 +222,14 @@ class MapManager:
         """An interactive 'clicker' to find coordinates of points.
         Helper for defining a new map
         """
-        # load pdf as image
-        pdf_document = pymupdf.open(pdf_path)
-        page = pdf_document[0]
-        print("Page rect: ", page.rect)
-        pdfimg = PIL.Image.open(io.BytesIO(page.get_pixmap().tobytes("png")))  # type: ignore
+        # load pdf as image (the document is shared, the rendering is cached)
+        with _locked_pdf_document(pdf_path) as pdf_document:
+            print("Page rect: ", pdf_document[0].rect)
+        pdfimg = MapManager.render_pdf_page(pdf_path)
         # set up plot
         matplotlib.use("TkAgg")
+        import matplotlib.pyplot as plt  # pylint: disable=import-outside-toplevel
+        from matplotlib.markers import MarkerStyle  # pylint: disable=import-outside-toplevel
         fig, ax = plt.subplots()
         ax.imshow(pdfimg)
         xlim = ax.get_xlim()
@@ -288,14 +331,14 @@ class MapManager:
                           (p.y - area.p0.y)/72*600)
                   for p in fullmap_points]
         # load pdf as image
-        pdf_document = pymupdf.open(pdf_path)
-        page = pdf_document[0]
-        clip = pymupdf.Rect(area.p0.x, area.p0.y, area.p1.x, area.p1.y)
-        pdfimg = PIL.Image.open(  # type: ignore
-            io.BytesIO(page.get_pixmap(clip=clip,  # type: ignore
-                                       dpi=600).tobytes("png")))
+        pdfimg = MapManager.render_pdf_page(pdf_path,
+                                            clip=(area.p0.x, area.p0.y, area.p1.x, area.p1.y),
+                                            dpi=600)
         # set up plot
         matplotlib.use("TkAgg")
+        import matplotlib.pyplot as plt  # pylint: disable=import-outside-toplevel
+        from matplotlib.markers import MarkerStyle  # pylint: disable=import-outside-toplevel
+        from matplotlib.backend_bases import MouseButton  # pylint: disable=import-outside-toplevel
         fig, ax = plt.subplots()
         ax.imshow(pdfimg)
         xlim = ax.get_xlim()
@@ -2,10 +2,9 @@
 import os
 import re
 import requests
-import pyproj
 import pandas as pd
 
-from .projutils import PointLonLat
+from .projutils import PointLonLat, _get_geod
 
 OURAIRPORTS_DATA_URL = "https://davidmegginson.github.io/ourairports-data/"
 ARC_POINT_DEF_RE = re.compile(r'^([A-Z]{3})\/(\d{1,3})\/([\d\.]*)\/([\d\.]*)$')
@@ -15,7 +14,7 @@ class NavAidDatabase:
 
     def __init__(self, workdir: str):
         self.workdir = workdir
-        self.geod = pyproj.Geod(
+        self.geod = _get_geod(
             "+proj=lcc +lon_0=-90 +lat_1=46 +lat_2=48 +ellps=WGS84")
         for ds_name in ['navaids', 'airports']:
             self.download_dataset(ds_name)
@@ -1,12 +1,16 @@
 """Helpers for projections
 """
-from typing import NamedTuple, Optional
+from typing import NamedTuple, Optional, Callable
+from functools import lru_cache
 import math
 import numpy as np
+from pyproj import CRS, Geod, Transformer
 
 from sympy import E, pi, oo, I, Symbol
 from sympy.parsing.latex import parse_latex
 
+from .jitutils import dojit, USE_NUMBA
+
 
 class PointLonLat(NamedTuple):
     """A point defined by longitude-latitude coordinates"""
@@ -64,17 +68,17 @@ def _rotate_point(point: PointXY, center: PointXY, angle_degrees: float) -> Poin
 
 
 def _calculate_2d_transformation_matrix(
-        source_points: list[PointXY],
-        destination_points: list[PointXY]):
+        source_points: list[PointXY] | np.ndarray,
+        destination_points: list[PointXY] | np.ndarray):
     """
     Calculate a 2D transformation matrix given two sets of corresponding
     points in source and destination coordinate systems.
 
     Parameters:
-    - source_points: List of tuples (x, y) representing points in the
-                     source coordinate system.
-    - destination_points: List of tuples (x, y) representing corresponding
-                          points in the destination coordinate system.
+    - source_points: List of tuples (x, y) (or an (N, 2) array) representing
+                     points in the source coordinate system.
+    - destination_points: List of tuples (x, y) (or an (N, 2) array) representing
+                          corresponding points in the destination coordinate system.
 
     Returns:
     - transformation_matrix: 3x3 numpy array representing the 2D
@@ -84,14 +88,10 @@ def _calculate_2d_transformation_matrix(
         raise ValueError(
             "Invalid input. Must have at least 2 corresponding points.")
 
-    matirx_a = np.zeros((len(source_points), 3))
-    matrix_b = np.zeros((len(source_points), 3))
-
-    for i, (x_s, y_s) in enumerate(source_points):
-        x_d, y_d = destination_points[i]
-
-        matirx_a[i] = [x_s, y_s, 1]
-        matrix_b[i] = [x_d, y_d, 1]
+    # homogeneous coordinates: (x, y, 1) rows
+    ones = np.ones((len(source_points), 1))
+    matirx_a = np.hstack((np.asarray(source_points, dtype=float).reshape(-1, 2), ones))
+    matrix_b = np.hstack((np.asarray(destination_points, dtype=float).reshape(-1, 2), ones))
 
     transformation_matrix, _, _, _ = np.linalg.lstsq(matirx_a, matrix_b, rcond=None)
     transformation_matrix = np.transpose(transformation_matrix)
@@ -99,6 +99,37 @@ def _calculate_2d_transformation_matrix(
     return transformation_matrix
 
 
+def _calculate_extent_transformation_matrix(source_extent: ExtentXY,
+                                            width: float,
+                                            height: float):
+    """
+    Calculate the 2D transformation matrix which maps an axis-aligned extent
+    onto the (0, 0)-(width, height) rectangle. It is only a scale and a
+    translation, so it is written out instead of fitting it on the corners
+    with `_calculate_2d_transformation_matrix`.
+
+    Parameters:
+    - source_extent: the extent in the source coordinate system.
+    - width, height: the size of the destination rectangle.
+
+    Returns:
+    - transformation_matrix: 3x3 numpy array representing the 2D
+      transformation matrix.
+    """
+    dx = source_extent.maxx - source_extent.minx
+    dy = source_extent.maxy - source_extent.miny
+    if dx == 0 or dy == 0:
+        # degenerate extent: leave it to the least squares solution
+        x0, y0, x1, y1 = source_extent
+        return _calculate_2d_transformation_matrix(
+            [(x0, y0), (x0, y1), (x1, y0), (x1, y1)],
+            [(0, 0), (0, height), (width, 0), (width, height)])
+    sx, sy = width / dx, height / dy
+    return np.array([[sx, 0., -sx*source_extent.minx],
+                     [0., sy, -sy*source_extent.miny],
+                     [0., 0., 1.]])
+
+
 def _apply_transformation_matrix(point, transformation_matrix):
     """
     Apply a 2D transformation matrix to a point.
@@ -120,9 +151,168 @@ def _apply_transformation_matrix(point, transformation_matrix):
     return transformed_point
 
 
-def _get_extent_from_points(points: list[PointLonLat]) -> ExtentLonLat:
+def _apply_transformation_matrix_batch(xs, ys, transformation_matrix):
+    """
+    Apply a 2D transformation matrix to a set of points at once.
+
+    Parameters:
+    - xs: array-like of the x coordinates of the original points.
+    - ys: array-like of the y coordinates of the original points.
+    - transformation_matrix: 3x3 numpy array representing the 2D transformation matrix.
+
+    Returns:
+    - transformed_points: Tuple (xs', ys') of numpy arrays of the transformed points.
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    if USE_NUMBA and xs.shape == ys.shape:
+        # one compiled loop, no temporary arrays
+        transformed_xs, transformed_ys = _apply_transformation_matrix_loop(
+            xs.ravel(), ys.ravel(), transformation_matrix)
+        return transformed_xs.reshape(xs.shape), transformed_ys.reshape(ys.shape)
+    # only the affine part is needed, no homogeneous coordinates are allocated
+    transformed_points = np.stack((xs, ys), axis=-1) @ transformation_matrix[:2, :2].T + \
+                         transformation_matrix[:2, 2]
+
+    return transformed_points[..., 0], transformed_points[..., 1]
+
+
+@dojit(cache=True)
+def _apply_transformation_matrix_loop(xs, ys, transformation_matrix):
+    """
+    The compiled kernel of `_apply_transformation_matrix_batch` (used with numba only).
+
+    Parameters:
+    - xs, ys: 1D numpy arrays of the coordinates of the original points.
+    - transformation_matrix: 3x3 numpy array representing the 2D transformation matrix.
+
+    Returns:
+    - transformed_points: Tuple (xs', ys') of numpy arrays of the transformed points.
+    """
+    m = transformation_matrix
+    m00, m01, m02, m10, m11, m12 = m[0, 0], m[0, 1], m[0, 2], m[1, 0], m[1, 1], m[1, 2]
+    transformed_xs = np.empty_like(xs)
+    transformed_ys = np.empty_like(ys)
+    for i in range(xs.shape[0]):  # pylint: disable=not-an-iterable
+        transformed_xs[i] = m00*xs[i] + m01*ys[i] + m02
+        transformed_ys[i] = m10*xs[i] + m11*ys[i] + m12
+    return transformed_xs, transformed_ys
+
+
+@dojit(cache=True)
+def _apply_transformation_matrix_scalar(x, y, transformation_matrix):
+    """
+    Apply a 2D transformation matrix to a single point given as two floats.
+    It is the fast path of projecting one point: no arrays are built.
+
+    Parameters:
+    - x, y: the coordinates of the original point.
+    - transformation_matrix: 3x3 numpy array representing the 2D transformation matrix.
+
+    Returns:
+    - transformed_point: Tuple (x', y') representing the transformed point.
+    """
+    m = transformation_matrix
+    return m[0, 0]*x + m[0, 1]*y + m[0, 2], m[1, 0]*x + m[1, 1]*y + m[1, 2]
+
+
+def _invert_affine3(transformation_matrix):
+    """
+    Invert a 2D (affine) transformation matrix in closed form.
+
+    Parameters:
+    - transformation_matrix: 3x3 numpy array representing the 2D transformation
+      matrix. Its third row is treated as [0, 0, 1].
+
+    Returns:
+    - inverse_matrix: 3x3 numpy array representing the inverse transformation.
+    """
+    (a, b, tx), (c, d, ty) = transformation_matrix[:2].tolist()
+    det = a*d - b*c
+    if det == 0:
+        raise np.linalg.LinAlgError("Singular matrix")
+    ia, ib, ic, id_ = d/det, -b/det, -c/det, a/det
+    return np.array([[ia, ib, -(ia*tx + ib*ty)],
+                     [ic, id_, -(ic*tx + id_*ty)],
+                     [0., 0., 1.]])
+
+
+class _TransformationCache:
+    """A small cache of transformation matrices (with their inverses) keyed by
+    the inputs they were calculated from (a hashable tuple). The oldest one is
+    dropped when full."""
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._matrices: dict[tuple, tuple[np.ndarray, np.ndarray]] = {} # (matrix, inverse)
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self._matrices
+
+    def __getitem__(self, key: tuple) -> tuple[np.ndarray, np.ndarray]:
+        return self._matrices[key]
+
+    def put(self, key: tuple, matrix: np.ndarray):
+        """Save a transformation matrix (and its inverse)"""
+        if len(self._matrices) >= self._maxsize:
+            del self._matrices[next(iter(self._matrices))] # drop the oldest one
+        self._matrices[key] = (matrix, _invert_affine3(matrix))
+
+
+def _compose_transformation_matrices(*transformation_matrices):
+    """
+    Compose 2D transformation matrices into one.
+
+    Parameters:
+    - transformation_matrices: 3x3 numpy arrays in the order they should be
+      applied (i.e. the first one is applied first).
+
+    Returns:
+    - transformation_matrix: 3x3 numpy array representing the composed
+      2D transformation matrix.
+    """
+    composed = np.identity(3)
+    for transformation_matrix in transformation_matrices:
+        affine = np.array(transformation_matrix, dtype=float)
+        affine[2] = [0, 0, 1] # the third row is dropped when applied, so drop it here too
+        composed = affine @ composed
+    return composed
+
+
+@lru_cache(maxsize=8)
+def _get_transformers(proj_str: str) -> tuple[Callable, Callable]:
+    """
+    Build (once for every projection definition) the forward (lon-lat to x-y)
+    and inverse (x-y to lon-lat) transformation functions of a projection.
+
+    Parameters:
+    - proj_str: the PROJ definition string of the projection.
+
+    Returns:
+    - transformers: Tuple (forward, inverse) of the `transform` methods. Both
+      accept scalars and numpy arrays as well.
+    """
+    proj_crs = CRS(proj_str)
+    lonlat_crs = proj_crs.geodetic_crs
+    return (Transformer.from_crs(lonlat_crs, proj_crs, always_xy=True).transform,
+            Transformer.from_crs(proj_crs, lonlat_crs, always_xy=True).transform)
+
+
+@lru_cache(maxsize=8)
+def _get_geod(proj_str: str) -> Geod:
+    """Build (once for every projection definition) the geodesic
+    calculation object of the projection's ellipsoid."""
+    return Geod(proj_str)
+
+
+def _get_extent_from_points(points: list[PointLonLat] | np.ndarray) -> ExtentLonLat:
     if len(points)==0:
         raise ValueError("Can't get extent from zero points")
+    if isinstance(points, np.ndarray):
+        # fast path: an (N, 2) array of lon-lat pairs
+        min_lon, min_lat = points.min(axis=0).tolist()
+        max_lon, max_lat = points.max(axis=0).tolist()
+        return ExtentLonLat(min_lon, min_lat, max_lon, max_lat)
     min_lat, max_lat, min_lon, max_lon = \
         90, -90, 180, -180 # something which will surely change
     for p in points:
@@ -136,14 +326,12 @@ def _get_extent_from_points(points: list[PointLonLat]) -> ExtentLonLat:
 def _get_extent_from_extents(extents: list[ExtentLonLat]) -> ExtentLonLat:
     if len(extents) == 0:
         raise ValueError("Can't get extent from zero extents")
-    min_lat, max_lat, min_lon, max_lon = \
-        90, -90, 180, -180 # something which will surely change
-    for ex in extents:
-        min_lat = min(n for n in [min_lat, ex.minlat, ex.maxlat] if n is not None)
-        max_lat = max(n for n in [max_lat, ex.minlat, ex.maxlat] if n is not None)
-        min_lon = min(n for n in [min_lon, ex.minlon, ex.maxlon] if n is not None)
-        max_lon = max(n for n in [max_lon, ex.minlon, ex.maxlon] if n is not None)
-    return ExtentLonLat(min_lon, min_lat, max_lon, max_lat)
+    # reduce the stacked (N, 4) array, missing (None) values become NaN and
+    # are ignored, the initial values are the same "surely changing" bounds
+    arr = np.array(extents, dtype=float)
+    lons, lats = arr[:, [0, 2]], arr[:, [1, 3]]
+    return ExtentLonLat(float(np.nanmin(lons, initial=180)), float(np.nanmin(lats, initial=90)),
+                        float(np.nanmax(lons, initial=-180)), float(np.nanmax(lats, initial=-90)))
 
 
 def parse_latex_with_constants(s: str):
@@ -0,0 +1,105 @@
+"""
+Downloading and caching the realtime data (weather forecasts and magnetic
+declinations) used by the annotations of a route
+"""
+import datetime
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Iterable
+
+import requests
+
+from .geometry import (
+    OPENWEATHER_ENDPOINT, OPENWEATHER_APIKEY,
+    MAGDEV_ENDPOINT, MAGDEV_APIKEY
+)
+
+
+_logger = logging.getLogger(__name__)
+
+# shared by all routes, so the number of parallel downloads stays bounded
+# (the threads are only started when the first download is submitted)
+_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="realtimedata")
+
+
+class RealtimeDataCache:
+    """The weather forecasts and magnetic declinations downloaded for a route.
+    Nearby points (rounded to 0.01 degree) share one download. A forecast is
+    downloaded again after `WEATHER_MAX_AGE` seconds, a declination is kept
+    for its date.
+    """
+
+    WEATHER_MAX_AGE = int(os.getenv("WEATHER_MAX_AGE", "3600")) # seconds
+
+    def __init__(self, session: requests.Session):
+        self._session = session
+        self._weather: dict[tuple, tuple[float, dict]] = {} # (download time, forecast)
+        self._declination: dict[tuple, float] = {}
+
+    @property
+    def weather(self):
+        """A read-only property to access the downloaded weather forecasts
+        (keyed by rounded lon-lat)"""
+        return {key: forecast for key, (_, forecast) in self._weather.items()}
+
+    def _has_weather(self, key: tuple) -> bool:
+        """Private helper: is there a forecast for `key` which is not too old"""
+        cached = self._weather.get(key)
+        return cached is not None and time.monotonic()-cached[0] < self.WEATHER_MAX_AGE
+
+    @property
+    def declination(self):
+        """A read-only property to access the downloaded magnetic declinations
+        (keyed by rounded lon-lat and date)"""
+        return self._declination
+
+    def get_weather_at(self, lon: float, lat: float) -> dict:
+        """Downloads (or gets from the cache) the weather forecast at a lon-lat point.
+        A failed download raises `requests.HTTPError` and is not cached."""
+        key = (round(lon, 2), round(lat, 2))
+        if not self._has_weather(key):
+            response = self._session.get(OPENWEATHER_ENDPOINT.format(
+                lon=key[0],
+                lat=key[1],
+                OPENWEATHER_APIKEY=OPENWEATHER_APIKEY
+            ), timeout=10)
+            response.raise_for_status() # an error body must not be cached as a forecast
+            self._weather[key] = (time.monotonic(), response.json())
+        return self._weather[key][1]
+
+    def get_declination_at(self, lon: float, lat: float, when: datetime.datetime) -> float:
+        """Downloads (or gets from the cache) the magnetic declination at a lon-lat point.
+        A failed download raises `requests.HTTPError` and is not cached."""
+        key = (round(lon, 2), round(lat, 2), when.date())
+        if key not in self._declination:
+            api_res = self._session.get(MAGDEV_ENDPOINT.format(
+                lon = key[0],
+                lat = key[1],
+                MAGDEV_APIKEY = MAGDEV_APIKEY,
+                when = when
+            ), timeout=10)
+            api_res.raise_for_status()
+            api_res = api_res.json()
+            self._declination[key] = api_res["result"][0]["declination"]
+        return self._declination[key]
+
+    def prefetch(self, points: Iterable[tuple[float, float]], when: datetime.datetime):
+        """Downloads the weather forecasts and magnetic declinations of several
+        lon-lat points in parallel, so they are found in the cache later.
+        A failed download is logged and not cached, the point asks again when
+        it needs the data.
+        """
+        keys = {(round(lon, 2), round(lat, 2)) for lon, lat in points}
+        futures = []
+        for lon, lat in keys:
+            if not self._has_weather((lon, lat)):
+                futures.append(_EXECUTOR.submit(self.get_weather_at, lon, lat))
+            if (lon, lat, when.date()) not in self._declination:
+                futures.append(_EXECUTOR.submit(self.get_declination_at, lon, lat, when))
+        wait(futures)
+        for future in futures:
+            error = future.exception()
+            if error is not None:
+                _logger.warning("Could not prefetch realtime data: %s", error)
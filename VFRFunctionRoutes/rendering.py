@@ -1,27 +1,206 @@
 """
 Tile rendering capabilities
 """
+from contextlib import contextmanager
 import io
 import math
 import os
+import threading
 from typing import Callable, Iterator, NamedTuple, Optional, Literal
 import time
 import matplotlib
 
 matplotlib.use("Agg")
 # pylint: disable=wrong-import-position
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg, RendererAgg
+import matplotlib.axes
+import matplotlib.colors
+import matplotlib.path
+import numpy as np
 import PIL
 import pymupdf
 
 from .projutils import PointXY
 from .remote_cache import IRemoteCache
+from .imageutils import paste_img
 # pylint: enable=wrong-import-position
 
 
 SimpleRect = NamedTuple('SimpleRect', [('p0', PointXY), ('p1', PointXY)])
 PointXYInt = NamedTuple('PointXYInt', [('x', int), ('y', int)])
 
+_FIG_POOL: list[tuple[Figure, matplotlib.axes.Axes]] = []
+_FIG_POOL_LOCK = threading.Lock()
+_FIG_POOL_MAXSIZE = 4
+
+# path -> (mtime, document, the lock of the document)
+_PDF_DOCUMENTS: dict[str, tuple[float, pymupdf.Document, threading.Lock]] = {}
+_PDF_DOCUMENTS_LOCK = threading.Lock()
+
+
+def _acquire_map_figure() -> tuple[Figure, matplotlib.axes.Axes]:
+    """Get a Figure with one borderless Axes filling it (what all map drawings
+    use) from the pool, or create one. Setting up the Axes is the expensive part
+    of a new Figure, a pooled one only has its previous artists removed.
+    A Figure is only handed out to one user (thread) at a time, give it back
+    with `_release_map_figure`."""
+    with _FIG_POOL_LOCK:
+        if len(_FIG_POOL) > 0:
+            return _FIG_POOL.pop()
+    fig = Figure()
+    ax = fig.add_axes((0., 0., 1., 1.))
+    ax.set_axis_off()
+    return fig, ax
+
+
+def _release_map_figure(fig: Figure):
+    """Clear the drawing from a Figure got from `_acquire_map_figure` and
+    put it back to the pool (or just drop it when the pool is full)."""
+    axes = fig.get_axes()
+    if len(axes) != 1:
+        return # not one of ours any more
+    ax = axes[0]
+    for artist in [*ax.lines, *ax.collections, *ax.texts, *ax.patches, *ax.images]:
+        artist.remove()
+    # undo the per-use settings so the next user gets a figure like a new one
+    # (a new plain canvas drops the renderer and the background of the last one)
+    FigureCanvasAgg(fig)
+    fig.patch.set_alpha(None)
+    ax.patch.set_alpha(None)
+    fig.set_dpi(matplotlib.rcParams['figure.dpi'])
+    fig.set_size_inches(matplotlib.rcParams['figure.figsize'])
+    ax.set_xlim(0., 1.)
+    ax.set_ylim(0., 1.)
+    ax.ignore_existing_data_limits = True
+    ax.set_autoscale_on(True)
+    with _FIG_POOL_LOCK:
+        if len(_FIG_POOL) < _FIG_POOL_MAXSIZE:
+            _FIG_POOL.append((fig, ax))
+
+
+class _BackgroundRendererAgg(RendererAgg):  # pylint: disable=abstract-method
+    """An Agg renderer which starts every drawing from a background image
+    (e.g. the composited map tiles) instead of a transparent canvas."""
+    def __init__(self, width, height, dpi, background: np.ndarray):
+        super().__init__(width, height, dpi)
+        self._background = background
+
+    def clear(self):
+        buf = np.asarray(self.buffer_rgba())
+        if buf.shape == self._background.shape:
+            buf[...] = self._background # clearing is just copying the background
+        else:
+            buf[...] = 0
+            paste_img(buf, self._background, 0, 0)
+
+
+class _BackgroundCanvasAgg(FigureCanvasAgg):
+    """An Agg canvas drawing on top of a background image (or on a transparent
+    canvas if it is None). The background belongs to the canvas, so (unlike
+    patching RendererAgg.clear) it does not affect the other drawings."""
+    def __init__(self, figure: Figure, background: Optional[np.ndarray] = None):
+        super().__init__(figure)
+        self._background = background
+        # our own renderer cache (like Agg's, but without its private attributes)
+        self._background_renderer: Optional[_BackgroundRendererAgg] = None
+        self._background_key: Optional[tuple] = None
+
+    def get_renderer(self):
+        if self._background is None:
+            return super().get_renderer()
+        w, h = self.figure.bbox.size
+        key = w, h, self.figure.dpi
+        if self._background_renderer is None or self._background_key != key:
+            self._background_renderer = _BackgroundRendererAgg(w, h, self.figure.dpi,
+                                                               self._background)
+            self._background_key = key
+        return self._background_renderer
+
+
+def _polylines_to_svg(lines: list[np.ndarray],
+                      colors: list[str],
+                      widths: list[float],
+                      image_size: PointXY,
+                      dpi: float) -> str:
+    """Write polylines (given in pixel coordinates of an image of `image_size`
+    at `dpi`) directly as SVG paths. The document has the same size, units
+    (points) and line styles as the `savefig` of a map Figure drawing the
+    same lines, without the cost of the MatPlotLib drawing machinery."""
+    scale = 72 / dpi
+    width, height = image_size.x*scale, image_size.y*scale
+    buf = io.StringIO()
+    buf.write('<?xml version="1.0" encoding="utf-8" standalone="no"?>\n'
+              '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+              f'width="{width:f}pt" height="{height:f}pt" viewBox="0 0 {width:f} {height:f}">\n'
+              ' <defs>\n'
+              '  <clipPath id="route_lines_clip">\n'
+              f'   <rect x="0" y="0" width="{width:f}" height="{height:f}"/>\n'
+              '  </clipPath>\n'
+              ' </defs>\n'
+              ' <g clip-path="url(#route_lines_clip)">\n')
+    for line, color, lw in zip(lines, colors, widths):
+        pts = np.asarray(line, dtype=float).reshape(-1, 2) * scale
+        pts = pts[np.isfinite(pts).all(axis=1)]
+        if len(pts) == 0:
+            continue
+        # drop the invisible details just like savefig (its C++ path simplifier)
+        path = matplotlib.path.Path(pts)
+        cleaned = path.cleaned(simplify=path.should_simplify)
+        pts = cleaned.vertices[cleaned.codes != matplotlib.path.Path.STOP]
+        rgba = matplotlib.colors.to_rgba(color)
+        opacity = f" stroke-opacity: {rgba[3]:g};" if rgba[3] < 1 else ""
+        path = " L ".join(f"{x:.3f} {y:.3f}" for x, y in pts.tolist())
+        buf.write(f'  <path d="M {path}" style="fill: none; '
+                  f'stroke: {matplotlib.colors.to_hex(rgba)}; stroke-width: {lw:g};{opacity} '
+                  'stroke-linecap: square; stroke-linejoin: round"/>\n')
+    buf.write(' </g>\n</svg>\n')
+    return buf.getvalue()
+
+
+def _get_pdf_document(pdf_path: str) -> tuple[pymupdf.Document, threading.Lock]:
+    """Get the shared, already opened Document of a PDF (opening a big map
+    is slow and every TileRenderer and helper of the map needs the same file)
+    with its lock. MuPDF documents are not thread-safe, so only use the
+    Document while holding the lock (see `_locked_pdf_document`).
+    It is reopened when the file changes on disk, and the replaced Document
+    is closed as soon as its current user releases the lock."""
+    key = os.path.abspath(pdf_path)
+    mtime = os.path.getmtime(key)
+    replaced = None
+    with _PDF_DOCUMENTS_LOCK:
+        cached = _PDF_DOCUMENTS.get(key)
+        if cached is None or cached[0] != mtime:
+            replaced = cached
+            cached = (mtime, pymupdf.open(key), threading.Lock())
+            _PDF_DOCUMENTS[key] = cached
+    if replaced is not None:
+        with replaced[2]:
+            replaced[1].close()
+    return cached[1], cached[2]
+
+
+@contextmanager
+def _locked_pdf_document(pdf_path: str) -> Iterator[pymupdf.Document]:
+    """Use the shared Document of a PDF (see `_get_pdf_document`) while
+    holding its lock. If the Document got replaced (and closed) while
+    waiting for the lock, the new one is used."""
+    while True:
+        document, lock = _get_pdf_document(pdf_path)
+        with lock:
+            if not document.is_closed:
+                yield document
+                return
+
+
+def _pixmap_to_pil(pixmap: pymupdf.Pixmap) -> PIL.Image:  # type: ignore
+    """Wrap the samples of a rendered Pixmap into a PIL Image directly
+    (instead of encoding and decoding a PNG in between)"""
+    return PIL.Image.frombytes("RGBA" if pixmap.alpha else "RGB",  # type: ignore
+                               (pixmap.width, pixmap.height),
+                               pixmap.samples)
+
+
 class TileRenderer:
     """
     A class rendering tiles from a map in a pdf.
@@ -58,13 +237,12 @@ class TileRenderer:
         self._remote_cache = remote_cache
         self.local_cache = os.getenv("USE_LOCAL_CACHE", "False").lower() in ["true", "yes", "on", "1"]
 
-        # open pdf
-        self._pdf_document: pymupdf.Document = pymupdf.open(
-            os.path.join(self.datafolder, self.pdf_fname))
-        self._page = self._pdf_document[self.page_num]
+        # the pdf is opened once and shared with the other users of the same file
+        self._pdf_path = os.path.join(self.datafolder, self.pdf_fname)
+        with _locked_pdf_document(self._pdf_path) as pdf_document:
+            self._page_rect = pdf_document[self.page_num].rect
 
         # calculate image and tile sizes
-        self._page_rect = self._page.rect
         self._crop_rect = pymupdf.Rect(
             (self._page_rect.x0 + self.pdf_margins.p0.x),
             (self._page_rect.y0 + self.pdf_margins.p0.y),
@@ -80,16 +258,28 @@ class TileRenderer:
             math.ceil(self.image_size.y / self.tile_size.y))
 
 
-    def __del__(self):
-        self._pdf_document.close()
-
-
     @property
     def crop_rect(self):
         """A read-only accessor to our region"""
         return self._crop_rect
 
 
+    def composite_area(self, crop_rect: SimpleRect) -> np.ndarray:
+        """Composite the tiles of a given area (in PDF coordinates, see
+        `get_tile_list_for_area`) into one RGBA image."""
+        tile_list, crop, image_size, tile_range = self.get_tile_list_for_area(crop_rect)
+        image = np.zeros((int(image_size.y), int(image_size.x), 4), dtype=np.uint8)
+        # the tiles don't overlap, so they are pasted row by row (not in the
+        # display order of the tile list) with all the offsets calculated at once
+        txy = np.array(sorted(tile_list, key=lambda p: (p.y, p.x)), dtype=np.int64).reshape(-1, 2)
+        # we need to shift the images, cropping not needed (its outside anyway)
+        offsets = ((txy - (tile_range[0], tile_range[2]))*self.tile_size
+                   - (crop.p0.x, crop.p0.y)).astype(np.int64)
+        for (tx, ty), (x, y) in zip(txy.tolist(), offsets.tolist()):
+            paste_img(image, np.asarray(self.get_tile(tx, ty)[1]), x, y)
+        return image
+
+
     def get_tile_list_for_area(self, crop_rect: SimpleRect) -> tuple[
             list[PointXYInt], SimpleRect, PointXYInt, tuple[float, float, float, float]
         ]:
@@ -166,30 +356,15 @@ class TileRenderer:
                 img = PIL.Image.open(io.BytesIO(png_bytes))  # type: ignore
                 return png_bytes, img if img.mode=='RGBA' else img.convert('RGBA')
 
-        # render
-        self.render_tile(x, y)
-
-        # check local cache again
-        if os.path.isfile(tilecache_fname):
-            with open(tilecache_fname, "rb") as f:
-                png_bytes = f.read()
-            img = PIL.Image.open(io.BytesIO(png_bytes))  # type: ignore
-            return png_bytes, img if img.mode=='RGBA' else img.convert('RGBA')
-
-        # check remote cache again
-        if self._remote_cache is not None:
-            if self._remote_cache.file_exists(tilecache_remote):
-                self._remote_cache.download_file(tilecache_remote, tilecache_fname)
-                with open(tilecache_fname, "rb") as f:
-                    png_bytes = f.read()
-                img = PIL.Image.open(io.BytesIO(png_bytes))  # type: ignore
-                return png_bytes, img if img.mode=='RGBA' else img.convert('RGBA')
+        # render (we already have the image, no need to read it back from the caches)
+        png_bytes, img = self.render_tile(x, y)
+        return png_bytes, img if img.mode=='RGBA' else img.convert('RGBA')
 
 
     def render_tile(self,
                     x: int, y: int
-                   ):
-        """Render the image and write it to caches"""
+                   ) -> tuple[bytes, PIL.Image]: # type: ignore
+        """Render the image, write it to caches and return it"""
         tilecache_fname, tilecache_remote = self.get_tile_fnames(x, y)
 
         # calculate the clip coordinates
@@ -205,7 +380,9 @@ class TileRenderer:
         )
 
         # render pdf into pixmap and get PNG
-        pixmap: pymupdf.Pixmap = self._page.get_pixmap(clip=clip, dpi=self.dpi)  # type: ignore
+        with _locked_pdf_document(self._pdf_path) as pdf_document:
+            pixmap: pymupdf.Pixmap = pdf_document[self.page_num].get_pixmap(  # type: ignore
+                clip=clip, dpi=self.dpi)
         buf = pixmap.tobytes("png")
 
         # put tile to local cache if enabled
@@ -217,6 +394,8 @@ class TileRenderer:
         if self._remote_cache is not None:
             self._remote_cache.upload_file(tilecache_fname, tilecache_remote)
 
+        return buf, _pixmap_to_pil(pixmap)
+
 
     def check_cached(self,
                      x: int, y: int
@@ -291,19 +470,25 @@ class TileRenderer:
 
 class SVGRenderer():  # pylint: disable=too-few-public-methods
     """
-    Renders overlays (no map background) with Matplotlib into svg byte arrays
+    Renders overlays (no map background) with Matplotlib into svg byte arrays.
+    Overlays of plain lines (`lines_func` returning the lines, colors and widths
+    instead of `draw_func` returning a Figure) are written directly.
     """
-    def __init__(self,
+    def __init__(self,  # pylint: disable=too-many-arguments,disable=too-many-positional-arguments
                  crop_rect: SimpleRect,
                  crop_rect_source: Literal['pdf', 'target'],
                  dpi: float,
                  original_dpi: float,
-                 draw_func: Callable
+                 draw_func: Optional[Callable] = None,
+                 lines_func: Optional[Callable] = None
                  ):
+        if (draw_func is None) == (lines_func is None):
+            raise ValueError("Exactly one of draw_func and lines_func must be given")
         # save parameters
         self.dpi = dpi
         self.odpi = original_dpi
         self._draw_func = draw_func
+        self._lines_func = lines_func
         # calculate image size
         if crop_rect_source == 'pdf':
             self.image_size = PointXY((crop_rect.p1.x-crop_rect.p0.x) / 72 * self.dpi,
@@ -316,21 +501,26 @@ class SVGRenderer():  # pylint: disable=too-few-public-methods
     def get_svg(self):
         """A converter of matplotlib plots to svg"""
 
-        matplotlib.rcParams['svg.fonttype'] = 'none'  # Use text, not curves
-
         start = time.perf_counter_ns()
-        fig=self._draw_func()
-
-        fig.set_size_inches((c/self.odpi for c in self.image_size))
-        ax=fig.get_axes()[0]
-        ax.set_xlim(0, self.image_size.x)
-        ax.set_ylim(self.image_size.y, 0)
+        if self._lines_func is not None:
+            svg = _polylines_to_svg(*self._lines_func(), self.image_size, self.odpi)
+            print(f"total time: {time.perf_counter_ns() - start:15,d}")
+            return svg
 
-        buf=io.StringIO()
-        fig.savefig(buf, format='svg', dpi=self.dpi, transparent=True)
-        buf.seek(0)
+        matplotlib.rcParams['svg.fonttype'] = 'none'  # Use text, not curves
 
-        plt.close(fig)
+        fig=self._draw_func()  # type: ignore
+        try:
+            fig.set_size_inches((c/self.odpi for c in self.image_size))
+            ax=fig.get_axes()[0]
+            ax.set_xlim(0, self.image_size.x)
+            ax.set_ylim(self.image_size.y, 0)
+
+            buf=io.StringIO()
+            fig.savefig(buf, format='svg', dpi=self.dpi, transparent=True)
+            buf.seek(0)
+        finally:
+            _release_map_figure(fig)
 
         print(f"total time: {time.perf_counter_ns() - start:15,d}")
 
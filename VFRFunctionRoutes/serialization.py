@@ -0,0 +1,122 @@
+"""
+Serialization of the routes to (and from) JSON serializable dictionaries and JSON strings
+"""
+import datetime
+import json
+from pathlib import Path
+from typing import Optional, Union, TYPE_CHECKING
+import requests
+try:
+    import orjson # a lot faster on the large (finalized) routes
+except ImportError:
+    orjson = None
+
+from .maps import MapManager
+from .geometry import VFRRouteState, VFRLeg, VFRTrack, VFRPoint, VFRAnnotation
+if TYPE_CHECKING:
+    from .functionroute import VFRFunctionRoute
+
+
+def dumps(obj) -> str:
+    """Serializes a dictionary (e.g. of `route_to_dict`) to an indented JSON string."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(obj, indent=2)
+
+
+def loads(jsonstring: str):
+    """Deserializes a JSON string (e.g. of `dumps`)."""
+    return orjson.loads(jsonstring) if orjson is not None else json.loads(jsonstring)
+
+
+def route_to_dict(rte: 'VFRFunctionRoute') -> dict:
+    """Converts a route to a serializable dictionary."""
+    # initiate json object with basic info
+    jsonrte = {
+        'name': rte.name,
+        'mapname': rte.map.name,
+        'speed': rte.speed,
+        'dof': rte.dof.isoformat(),
+        'state': rte.state.name
+    }
+    # step 1: area of interest
+    #if rte.state.value>=VFRRouteState.AREAOFINTEREST.value:
+    jsonrte['step1'] = { 'area_of_interest': {
+        'top-left': rte.area_of_interest['top-left'].to_dict(),
+        'bottom-right': rte.area_of_interest['bottom-right'].to_dict(),
+    }}
+    # step 2: waypoints
+    #if rte.state.value>=VFRRouteState.WAYPOINTS.value:
+    jsonrte['step2'] = { 'waypoints': [(wp[0], wp[1].to_dict()) for wp in rte.waypoints],
+                         'is_closed': rte.is_closed }
+    # step 3: legs
+    #if rte.state.value>=VFRRouteState.LEGS.value:
+    jsonrte['step3'] = { 'legs': [leg.to_dict() for leg in rte.legs] }
+    # step 4: annotation points
+    #if rte.state.value>=VFRRouteState.ANNOTATIONS.value:
+    jsonrte['step4'] = {
+        'annotations': [[ann.to_dict()
+                         for ann in leg.annotations]
+                        for leg in rte.legs]
+        }
+    # step 5: tracks
+    #if rte.state.value>=VFRRouteState.FINALIZED.value:
+    jsonrte['step5'] = { 'tracks': [t.to_dict() for t in rte.tracks]}
+    return jsonrte
+
+
+def route_from_dict(route_cls: type['VFRFunctionRoute'],  # pylint: disable=too-many-arguments,disable=too-many-positional-arguments
+                    jsonrte: dict,
+                    session: Optional[requests.Session] = None,
+                    workfolder: Union[str, Path, None] = None,
+                    outfolder: Union[str, Path, None] = None,
+                    tracksfolder: Union[str, Path, None] = None) -> 'VFRFunctionRoute':
+    """Creates a route (of `route_cls`) from a dictionary of `route_to_dict`."""
+    if MapManager.instance() is None:
+        raise ValueError('There is no MapManager initialized')
+    # initiate with basic info
+    rte = route_cls(jsonrte['name'],
+                    MapManager.instance().maps.get(jsonrte['mapname']), # type: ignore
+                    jsonrte['speed'],
+                    datetime.datetime.fromisoformat(jsonrte['dof']),
+                    session, workfolder, outfolder, tracksfolder)
+    state = VFRRouteState[jsonrte['state']]
+    # step 1: area of interest
+    #if state.value>=VFRRouteState.AREAOFINTEREST.value:
+    rte.area_of_interest = {
+        'top-left': VFRPoint.from_dict(
+            jsonrte['step1']['area_of_interest']['top-left'],
+            rte),
+        'bottom-right': VFRPoint.from_dict(
+            jsonrte['step1']['area_of_interest']['bottom-right'],
+            rte),
+    }
+    #rte.set_state(VFRRouteState.AREAOFINTEREST)
+    # step 2: waypoints
+    #if state.value>=VFRRouteState.WAYPOINTS.value:
+    rte.waypoints = [(name, VFRPoint.from_dict(p, rte))
+                     for name, p in jsonrte['step2']['waypoints']]
+    rte.is_closed = jsonrte['step2'].get('is_closed', True)
+    #rte.set_state(VFRRouteState.WAYPOINTS)
+    # step 3: legs
+    #if state.value>=VFRRouteState.LEGS.value:
+    rte.legs = [VFRLeg.from_dict(leg, rte)
+                for leg in jsonrte['step3']['legs']]
+    #rte.set_state(VFRRouteState.LEGS)
+    # step 4: annotation points
+    #if state.value>=VFRRouteState.ANNOTATIONS.value:
+    for i, l in enumerate(jsonrte['step4']['annotations']):
+        leg = rte.legs[i]
+        leg.annotations = [VFRAnnotation.from_dict(ann, leg)
+                           for ann in l]
+    #rte.set_state(VFRRouteState.ANNOTATIONS)
+    # step 5: tracks
+    #if state.value>=VFRRouteState.FINALIZED.value:
+    rte.tracks = [VFRTrack.from_dict(t, rte)
+                  for t in jsonrte['step5']['tracks']]
+    # the content was set directly, invalidate what was calculated from the defaults
+    rte._changed()  # pylint: disable=protected-access
+    #rte.set_state(VFRRouteState.FINALIZED)
+    # set final state and return
+    rte.set_state(state)
+    return rte
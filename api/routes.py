@@ -17,6 +17,8 @@ import uuid
 import logging
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from fastapi import APIRouter, HTTPException, Response
 from fastapi_socketio import SocketManager
@@ -53,6 +55,13 @@ routes = APIRouter()
 
 # set up maps
 global_requests_session = requests.Session()
+# the session is shared by all routes (the weather prefetch of each one runs
+# 8 downloads at once), so keep a bigger pool of connections per host
+for _scheme in ('https://', 'http://'):
+    global_requests_session.mount(_scheme, HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=int(os.getenv('HTTP_POOL_MAXSIZE', '32')),
+        max_retries=Retry(total=3, backoff_factor=0.2)))
 
 remote_cache = S3Cache()
 mapmanager = MapManager([int(os.getenv("LOW_DPI", "72")),
@@ -947,7 +956,8 @@ async def get_tracks_map(sid: str, session_id: str, rte: VFRFunctionRoute):  # p
     frontend should request each tile through the HTTP endpoint.
     """
     clip = rte.calc_basemap_clip()
-    svgrenderer = SVGRenderer(clip, 'pdf', rte.HIGH_DPI, rte.HIGH_DPI, draw_func=rte.draw_tracks)
+    svgrenderer = SVGRenderer(clip, 'pdf', rte.HIGH_DPI, rte.HIGH_DPI,
+                              lines_func=rte.get_track_lines)
     renderer = rte.map.get_tilerenderer(int(os.getenv('HIGH_DPI', '600')))
     assert renderer is not None
     loop = asyncio.get_running_loop()
@@ -972,7 +982,8 @@ async def load_track(sid: str, session_id: str, rte: VFRFunctionRoute, msg):  #
                   base64.b64decode(msg.get('data')))
     _vfrroutes.set(session_id, rte)
     clip = rte.calc_basemap_clip()
-    svgrenderer = SVGRenderer(clip, 'pdf', rte.HIGH_DPI, rte.HIGH_DPI, draw_func=rte.draw_tracks)
+    svgrenderer = SVGRenderer(clip, 'pdf', rte.HIGH_DPI, rte.HIGH_DPI,
+                              lines_func=rte.get_track_lines)
     loop = asyncio.get_running_loop()
     svg = await loop.run_in_executor(None, svgrenderer.get_svg)
     return {
@@ -996,7 +1007,8 @@ async def update_tracks(sid: str, session_id: str, rte: VFRFunctionRoute, msg):
     rte.update_tracks(msg.get('tracks'))
     _vfrroutes.set(session_id, rte)
     clip = rte.calc_basemap_clip()
-    svgrenderer = SVGRenderer(clip, 'pdf', rte.HIGH_DPI, rte.HIGH_DPI, draw_func=rte.draw_tracks)
+    svgrenderer = SVGRenderer(clip, 'pdf', rte.HIGH_DPI, rte.HIGH_DPI,
+                              lines_func=rte.get_track_lines)
     loop = asyncio.get_running_loop()
     svg = await loop.run_in_executor(None, svgrenderer.get_svg)
     return {